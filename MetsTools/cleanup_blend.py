@@ -1,5 +1,11 @@
 import bmesh
 import bpy
+import os
+import json
+import hashlib
+import numpy as np
+import time
+from contextlib import contextmanager
 from bpy.props import *
 from . import utils
 
@@ -8,6 +14,152 @@ from . import utils
 # Oh, and also everything else.
 # More specifically, I wonder if the "All" settings, to operate on bpy.data.objects, will work, when some objects are hidden or disabled, etc.
 
+string_props = {}
+"""Identifiers of the string properties that may hold a vertex group name, by key: RNA type identifier."""
+
+def get_string_props(owner):
+	""" Return the identifiers of the string properties of owner's type, which may reference a vertex group. Each RNA type is only introspected once. """
+	key = owner.bl_rna.identifier
+	props = string_props.get(key)
+	if(props is None):
+		# The name of a modifier or constraint is never a reference.
+		props = tuple(p.identifier for p in owner.bl_rna.properties if p.type=='STRING' and p.identifier!='name')
+		string_props[key] = props
+	return props
+
+class CleanUpReport:
+	""" Wall time and counts of removed items of each stage of a cleanup run. With dry_run, the cleanup functions only count what they would remove, without changing anything. """
+	counters = ['objects', 'removed_nodes', 'removed_slots', 'removed_groups', 'merged_materials', 'merged_images']
+
+	def __init__(self, dry_run=False):
+		self.dry_run = dry_run
+		self.stages = {}
+		"""Seconds and counters of each stage, by key: stage name."""
+
+	def get_stage(self, name):
+		if(name not in self.stages):
+			self.stages[name] = {'seconds' : 0.0}
+			for c in self.counters:
+				self.stages[name][c] = 0
+		return self.stages[name]
+
+	@contextmanager
+	def stage(self, name):
+		""" Time the code inside a with statement as part of a stage. Entering the same stage multiple times adds up. """
+		stage = self.get_stage(name)
+		start = time.perf_counter()
+		try:
+			yield stage
+		finally:
+			stage['seconds'] += time.perf_counter() - start
+
+	def total(self, key):
+		if(key == 'objects'):
+			# Each stage counts the objects it handled, so adding them up would count most objects several times.
+			return self.stages['objects']['objects'] if 'objects' in self.stages else 0
+		return sum(stage[key] for stage in self.stages.values())
+
+	def to_dict(self):
+		return {
+			'time' : time.strftime("%Y-%m-%dT%H:%M:%S"),
+			'file' : bpy.data.filepath,
+			'dry_run' : self.dry_run,
+			'seconds' : self.total('seconds'),
+			'stages' : self.stages,
+		}
+
+	def save(self, filepath):
+		with open(filepath, 'w') as f:
+			json.dump(self.to_dict(), f, indent=4)
+
+last_report = None
+"""CleanUpReport of the last run of CleanUpScene, displayed in the Scene properties."""
+
+class VGroupReferenceIndex:
+	""" Index of everything in the scene that references a vertex group by name, built once so that checking a vertex group is a dictionary lookup. """
+	def __init__(self, objs):
+		self.users = {}
+		"""Kinds of users referencing a vertex group: 'MODIFIER', 'CONSTRAINT', 'SHAPE_KEY' or 'BONE', by key: (object, vertex group name)."""
+
+		for obj in objs:
+			if(type(obj)!=bpy.types.Object or len(obj.vertex_groups)==0): continue
+			self.add_object(obj)
+
+		# Constraints on any object or bone can use a vertex group of a mesh as their subtarget.
+		for o in bpy.data.objects:
+			constraints = list(o.constraints)
+			if(o.type=='ARMATURE' and o.pose):
+				for b in o.pose.bones:
+					constraints.extend(b.constraints)
+			for c in constraints:
+				target = getattr(c, 'target', None)
+				subtarget = getattr(c, 'subtarget', "")
+				if(target and target.type=='MESH' and subtarget!=""):
+					self.add(target, subtarget, 'CONSTRAINT')
+
+	def add(self, obj, name, kind):
+		self.users.setdefault((obj, name), set()).add(kind)
+
+	def add_owner(self, obj, owner, kind):
+		# Any string property of the owner may be the name of a vertex group.
+		for attr in get_string_props(owner):
+			self.add(obj, getattr(owner, attr), kind)
+
+	def add_object(self, obj):
+		for m in obj.modifiers:
+			self.add_owner(obj, m, 'MODIFIER')
+			if(hasattr(m, 'settings')):	#Physics modifiers
+				self.add_owner(obj, m.settings, 'MODIFIER')
+			if(m.type=='PARTICLE_SYSTEM'):
+				self.add_owner(obj, m.particle_system, 'MODIFIER')
+
+			# Bone names from all armature modifiers.
+			if(m.type=='ARMATURE' and m.object):
+				for b in m.object.pose.bones:
+					self.add(obj, b.name, 'BONE')
+
+		if(obj.type=='MESH' and obj.data.shape_keys):
+			for kb in obj.data.shape_keys.key_blocks:
+				if(kb.vertex_group!=""):
+					self.add(obj, kb.vertex_group, 'SHAPE_KEY')
+
+	def is_used(self, obj, name, kinds):
+		""" Whether a vertex group is referenced by any of the given kinds of users. """
+		return not self.users.get((obj, name), set()).isdisjoint(kinds)
+
+def remove_unused_material_slots(mesh, users, dry_run=False):
+	""" Remove the material slots of a mesh that have no faces assigned, without using operators. Returns the number of removed slots.
+	dry_run: Only count the slots that would be removed.
+	"""
+	slot_count = len(mesh.materials)
+	indices = np.empty(len(mesh.polygons), dtype=np.int32)
+	mesh.polygons.foreach_get('material_index', indices)
+	used = np.unique(indices)
+	used = used[used < slot_count]
+	if(len(used) == slot_count or dry_run): return slot_count - len(used)
+
+	# Remap the faces to the slots' new indices in one write. Faces with out of range indices are left as they are.
+	remap = np.arange(max(slot_count, indices.max()+1), dtype=np.int32)
+	remap[used] = np.arange(len(used), dtype=np.int32)
+	mesh.polygons.foreach_set('material_index', remap[indices])
+
+	# Move the used slots to the front, then remove the slots left over at the end.
+	data_mats = [mesh.materials[i] for i in used]
+	obj_slots = [[(o.material_slots[i].link, o.material_slots[i].material) for i in used] for o in users]
+	for new_index, mat in enumerate(data_mats):
+		mesh.materials[new_index] = mat
+	for o, slots in zip(users, obj_slots):
+		for new_index, (link, mat) in enumerate(slots):
+			slot = o.material_slots[new_index]
+			slot.link = link
+			if(link=='OBJECT'):
+				slot.material = mat
+	for i in range(slot_count - len(used)):
+		mesh.materials.pop()
+
+	mesh.update()
+	return slot_count - len(used)
+
 class DeleteUnusedMaterialSlots(bpy.types.Operator):
 	""" Delete material slots on selected objects that have no faces assigned. """
 	bl_idname = "object.delete_unused_material_slots"
@@ -29,46 +181,98 @@ class DeleteUnusedMaterialSlots(bpy.types.Operator):
 		operator.opt_objects = 'Active'
 	
 	def execute(self, context):
-		org_active = context.object
-
 		objs = context.selected_objects
 		if(self.opt_objects=='Active'):
 			objs = [context.object]
 		elif(self.opt_objects=='All'):
 			objs = bpy.data.objects
 
+		# Face material indices written in edit mode are overwritten when leaving it, while the removed slots would stay removed.
+		org_mode = context.object.mode if context.object else 'OBJECT'
+		if(org_mode != 'OBJECT'):
+			bpy.ops.object.mode_set(mode='OBJECT')
+
+		# Objects sharing a mesh share its material slots, so each mesh is only processed once.
+		meshes = {}
 		for obj in objs:
 			if(type(obj)!=bpy.types.Object or 
 				obj.type!='MESH' or 
 				len(obj.data.polygons)==0): continue
+			meshes[obj.data] = []
 
-			bpy.context.view_layer.objects.active = obj
-			used_mat_indices = []
-			for f in obj.data.polygons:
-				if(f.material_index not in used_mat_indices):
-					used_mat_indices.append(f.material_index)
+		# Every user of the mesh needs its object-linked materials moved along with the slots.
+		for o in bpy.data.objects:
+			if(o.data in meshes):
+				meshes[o.data].append(o)
 
-			# To remove the material slots, we iterate in reverse.
-			for i in range(len(obj.material_slots)-1, -1, -1):
-				if(i not in used_mat_indices):
-					obj.active_material_index = i
-					print("Removed material slot " + str(i))
-					bpy.ops.object.material_slot_remove()
+		removed_count = 0
+		for mesh, users in meshes.items():
+			removed_count += remove_unused_material_slots(mesh, users)
 
-		bpy.context.view_layer.objects.active = org_active
+		if(org_mode != 'OBJECT'):
+			bpy.ops.object.mode_set(mode=org_mode)
+		self.report({'INFO'}, "Removed %d material slots." %removed_count)
 		return {'FINISHED'}
 
+def run_on_object(op, obj, **options):
+	""" Run an object operator on obj without making it the active object. """
+	if(hasattr(bpy.context, 'temp_override')):
+		# Blender 3.2 and later no longer take the override as an argument.
+		with bpy.context.temp_override(object=obj, active_object=obj):
+			return op(**options)
+	return op({'object' : obj, 'active_object' : obj}, **options)
+
+def run_on_objects(op, objs, **options):
+	""" Run an object operator on each of the objects with run_on_object().
+	Each operator call first updates the objects that were changed since the previous call, so running it on all objects before changing any of them through the data API is much faster than alternating the two.
+	"""
+	for obj in objs:
+		run_on_object(op, obj, **options)
+
+def clean_zero_weights(objs):
+	""" Remove the zero weights from the vertex groups of the objects. The operator does this in C, which is much faster than looking at each vertex's groups in Python. """
+	run_on_objects(bpy.ops.object.vertex_group_clean, [obj for obj in objs if len(obj.vertex_groups) > 0], group_select_mode='ALL', limit=0)
+
+def delete_unused_vgroups(obj, references, kinds, save_nonzero=False, dry_run=False):
+	""" Delete the vertex groups of an object that aren't referenced by any of the given kinds of users in the VGroupReferenceIndex, without changing the active object.
+	Zero weights should be removed first with clean_zero_weights(). With save_nonzero, groups that have any weights left, and their opposite side groups, are kept as well.
+	Returns the number of deleted groups. With dry_run, only the groups that would be deleted are counted.
+	"""
+	# Only looking at the weights when they matter. A single pass over the vertices finds every group that has a weight assigned.
+	used_groups = set()
+	if(save_nonzero and obj.type=='MESH'):
+		for v in obj.data.vertices:
+			for g in v.groups:
+				if(g.weight > 0):
+					used_groups.add(g.group)
+
+	# Saving vertex groups that are referenced by something and therefore should not be removed
+	safe_groups = set()	# Indices of vertex groups that shouldn't be deleted.
+	for vg in obj.vertex_groups:
+		if(references.is_used(obj, vg.name, kinds)):
+			safe_groups.add(vg.index)
+		
+	# Saving vertex groups that have any weights assigned to them, also considering mirror modifiers
+	if(save_nonzero):
+		for i in used_groups:
+			safe_groups.add(i)
+			opp_group = obj.vertex_groups.get(utils.flip_name(obj.vertex_groups[i].name))
+			if(opp_group):
+				safe_groups.add(opp_group.index)
+	
+	# Clearing vertex groups that didn't get saved
+	unused_groups = [vg for vg in obj.vertex_groups if vg.index not in safe_groups]
+	if(not dry_run):
+		for vg in unused_groups:
+			obj.vertex_groups.remove(vg)
+	return len(unused_groups)
+
 class DeleteUnusedVGroups(bpy.types.Operator):
-	""" Delete vertex groups that have no weights and/or aren't being used by any modifiers and/or don't correlate to any bones. """
+	""" Delete vertex groups that have no weights and/or aren't being used by any modifiers, constraints or shape keys and/or don't correlate to any bones. """
 	bl_idname = "object.delete_unused_vgroups"
 	bl_label = "Delete Unused Vertex Groups"
 	bl_options = {'REGISTER', 'UNDO'}
 	
-	# TODO: Should also consider vertex groups used by any kinds of constraints. 
-	# Oof. We'd have to look through the objects and bones of the entire scene for that. Maybe worth?
-
-	# TODO: Should also consider shape keys masks.
-
 	opt_objects: EnumProperty(name="Objects",
 		items=[	('Active', 'Active', 'Active'),
 				('Selected', 'Selected', 'Selected'),
@@ -91,10 +295,14 @@ class DeleteUnusedVGroups(bpy.types.Operator):
 	opt_save_shapekey_vgroups: BoolProperty(name="Save Shape Key Groups",
 		default=True,
 		description="Save vertex groups that are used by a shape key as a mask")
+
+	opt_save_constraint_vgroups: BoolProperty(name="Save Constraint Groups",
+		default=True,
+		description="Save vertex groups that are used as a subtarget by a constraint of any object or bone")
 	
 	@classmethod
 	def poll(cls, context):
-		return len(context.object.vertex_groups) > 0
+		return context.object and len(context.object.vertex_groups) > 0
 	
 	def draw_delete_unused(self, context):
 		operator = self.layout.operator(DeleteUnusedVGroups.bl_idname, text="Delete Unused Groups", icon='X')
@@ -106,108 +314,76 @@ class DeleteUnusedVGroups(bpy.types.Operator):
 		operator.opt_save_nonzero_vgroups = True
 
 	def execute(self, context):
-		org_active = context.object
-
 		objs = context.selected_objects
 		if(self.opt_objects=='Active'):
 			objs = [context.object]
 		elif(self.opt_objects=='All'):
 			objs = bpy.data.objects
 
+		# Kinds of references that save a vertex group
+		kinds = set()
+		if(self.opt_save_modifier_vgroups):
+			kinds.add('MODIFIER')
+		if(self.opt_save_bone_vgroups):
+			kinds.add('BONE')
+		if(self.opt_save_shapekey_vgroups):
+			kinds.add('SHAPE_KEY')
+		if(self.opt_save_constraint_vgroups):
+			kinds.add('CONSTRAINT')
+		references = VGroupReferenceIndex(objs)
+
+		# Vertex groups can't be removed through the data API in edit mode, and the vertex weights read in edit mode are out of date.
+		org_mode = context.object.mode
+		if(org_mode != 'OBJECT'):
+			bpy.ops.object.mode_set(mode='OBJECT')
+
+		objs = [obj for obj in objs if type(obj)==bpy.types.Object and len(obj.vertex_groups) > 0]
+		clean_zero_weights(objs)
+
+		removed_count = 0
 		for obj in objs:
-			if(len(obj.vertex_groups) == 0): continue
-			
-			bpy.context.view_layer.objects.active = obj
-
-			# Clean 0 weights
-			bpy.ops.object.vertex_group_clean(group_select_mode='ALL', limit=0)
-
-			# Saving vertex groups that are used by modifiers and therefore should not be removed
-			safe_groups = []
-			def save_groups_by_attributes(owner):
-				# Look through an object's attributes. If its value is a string, try to find a vertex group with the same name. If found, make sure we don't delete it.
-				for attr in dir(owner):
-					value = getattr(owner, attr)
-					if(type(value)==str):
-						vg = obj.vertex_groups.get(value)
-						if(vg):
-							safe_groups.append(vg)
-
-			# Save any vertex groups used by modifier parameters.
-			if(self.opt_save_modifier_vgroups):
-				for m in obj.modifiers:
-					save_groups_by_attributes(m)
-					if(hasattr(m, 'settings')):	#Physics modifiers
-						save_groups_by_attributes(m.settings)
-
-			# Getting a list of bone names from all armature modifiers.
-			bone_names = []
-			for m in obj.modifiers:
-				if(m.type == 'ARMATURE'):
-					armature = m.object
-					if armature is None:
-						continue
-					if(bone_names is None):
-						bone_names = list(map(lambda x: x.name, armature.pose.bones))
-					else:
-						bone_names.extend(list(map(lambda x: x.name, armature.pose.bones)))
-			
-			# Saving any vertex groups that correspond to a bone name
-			if(self.opt_save_bone_vgroups):
-				for bn in bone_names:
-					vg = obj.vertex_groups.get(bn)
-					if(vg):
-						safe_groups.append(vg)
-				
-			# Saving vertex groups that have any weights assigned to them, also considering mirror modifiers
-			if(self.opt_save_nonzero_vgroups):
-				for vg in obj.vertex_groups:	# For each vertex group
-					for i in range(0, len(obj.data.vertices)):	# For each vertex
-						try:
-							vg.weight(i)							# If there's a weight assigned to this vert (else exception)
-							if(vg not in safe_groups):
-								safe_groups.append(vg)
-								
-								opp_name = utils.flip_name(vg.name)
-								opp_group = obj.vertex_groups.get(opp_name)
-								if(opp_group):
-									safe_groups.append(opp_group)
-								break
-						except RuntimeError:
-							continue
-			
-			# Clearing vertex groups that didn't get saved
-			for vg in obj.vertex_groups:
-				if(vg not in safe_groups):
-					print("Unused vgroup removed: "+vg.name)
-					obj.vertex_groups.remove(vg)
+			removed_count += delete_unused_vgroups(obj, references, kinds, self.opt_save_nonzero_vgroups)
 		
-		bpy.context.view_layer.objects.active = org_active
+		if(org_mode != 'OBJECT'):
+			bpy.ops.object.mode_set(mode=org_mode)
+		self.report({'INFO'}, "Removed %d vertex groups." %removed_count)
 		return {'FINISHED'}
 
-def get_linked_nodes(nodes, node):	# Recursive function to collect all nodes connected BEFORE the second parameter.
-	nodes.append(node)
-	for i in node.inputs:
-		if(len(i.links) > 0):
-			get_linked_nodes(nodes, i.links[0].from_node)
-	return nodes
-
-def clean_node_tree(node_tree, delete_unused_nodes=True, fix_groups=False, center_nodes=True, fix_tex_refs=False, rename_tex_nodes=True, hide_sockets=False, min_sockets=2, tex_width=300):	# nodes = nodeTree.nodes
+def get_linked_nodes(node_tree, nodes):
+	""" Return the names of all nodes connected before the given nodes, following every link, including reroutes. """
+	# Gathering each node's upstream nodes once, rather than asking every socket for its links.
+	upstream = {}
+	for l in node_tree.links:
+		upstream.setdefault(l.to_node.name, []).append(l.from_node.name)
+
+	linked = set()
+	stack = [n.name for n in nodes]
+	while(len(stack) > 0):
+		name = stack.pop()
+		if(name in linked): continue
+		linked.add(name)
+		stack.extend(upstream.get(name, []))
+	return linked
+
+def clean_node_tree(node_tree, delete_unused_nodes=True, fix_groups=False, center_nodes=True, fix_tex_refs=False, rename_tex_nodes=True, hide_sockets=False, min_sockets=2, tex_width=300, dry_run=False):	# nodes = nodeTree.nodes
+	""" Returns the number of removed nodes. With dry_run, only the nodes that would be removed are counted, and nothing else is changed. """
 	nodes = node_tree.nodes
-	if(len(nodes)==0): return
+	if(len(nodes)==0): return 0
 
-	if(delete_unused_nodes):
-		# Deleting unconnected nodes
-		output_nodes = list(filter(lambda x: x.type in ['OUTPUT_MATERIAL', 'OUTPUT_WORLD', 'COMPOSITE', 'VIEWER'], nodes))
-		used_nodes = []
-		for on in output_nodes:
-			used_nodes.extend(get_linked_nodes([], on))
+	# Deleting unconnected nodes. Trees without any output node are left alone, since everything would count as unconnected.
+	output_nodes = [n for n in nodes if n.type in {'OUTPUT_MATERIAL', 'OUTPUT_WORLD', 'OUTPUT_LIGHT', 'OUTPUT_AOV', 'OUTPUT_LINESTYLE', 'GROUP_OUTPUT', 'COMPOSITE', 'VIEWER', 'SPLITVIEWER', 'OUTPUT_FILE'}]
+	unused_nodes = []
+	if(delete_unused_nodes and len(output_nodes) > 0):
+		used_nodes = get_linked_nodes(node_tree, output_nodes)
+		unused_nodes = [n for n in nodes if n.name not in used_nodes and n.type != 'FRAME']
+	if(dry_run): return len(unused_nodes)
 
-		for n in nodes:
-			if(n not in used_nodes and n.type != 'FRAME'):
-				print("Removing unconnected node: Type: " + n.type + " Name: " + n.name + " Label: " + n.label)
-				nodes.remove(n)
-				continue
+	# Removing in a separate pass, since removing nodes while iterating over them skips some.
+	removed_count = len(unused_nodes)
+	for n in unused_nodes:
+		nodes.remove(n)
+
+	if(all(n.type == 'FRAME' for n in nodes)): return removed_count
 
 	# Finding bounding box of all nodes
 	x_min = min(n.location.x for n in nodes if n.type!= 'FRAME')
@@ -269,17 +445,324 @@ def clean_node_tree(node_tree, delete_unused_nodes=True, fix_groups=False, cente
 				n.location.x -= x_mid
 				n.location.y -= y_mid
 
-		if(fix_groups):
-			# Changing references to nodegroups ending in .00x to their original. If the original doesn't exist, rename the nodegroup.
-			for n in nodes:
-				if(n.type=='GROUP'):
-					if('.00' in n.node_tree.name):
-						existing = bpy.data.node_groups.get(n.node_tree.name[:-4])
-						if(existing):
-							n.node_tree = existing
-						else:
-							n.node_tree.name = n.node_tree.name[:-4]
+	if(fix_groups):
+		# Changing references to nodegroups ending in .00x to their original. If the original doesn't exist, rename the nodegroup.
+		for n in nodes:
+			if(n.type=='GROUP' and n.node_tree):
+				if('.00' in n.node_tree.name):
+					existing = bpy.data.node_groups.get(n.node_tree.name[:-4])
+					if(existing):
+						n.node_tree = existing
+					else:
+						n.node_tree.name = n.node_tree.name[:-4]
+
+	return removed_count
 	
+node_tree_hash_prop = "cleanup_hash"
+"""Node tree ID property storing the structural hash of the tree after it was last cleaned up."""
+
+def get_node_tree_hash(node_tree, options):
+	""" Return a hash of everything in the node tree that clean_node_tree() looks at or changes, and the options it is called with. """
+	data = [sorted(options.items())]
+	for n in node_tree.nodes:
+		image = getattr(n, 'image', None)
+		group = getattr(n, 'node_tree', None)
+		# fix_tex_refs and fix_groups depend on whether a datablock without the .00x suffix exists, which can change without the tree changing, e.g. when it's appended later.
+		image_base_exists = bool(options.get('fix_tex_refs') and image and image.name[-4:-3] == '.' and image.name[:-4] in bpy.data.images)
+		group_base_exists = bool(options.get('fix_groups') and group and '.00' in group.name and group.name[:-4] in bpy.data.node_groups)
+		data.append((n.name, n.bl_idname, n.label, round(n.location.x, 2), round(n.location.y, 2), round(n.width, 2), n.hide,
+			n.parent.name if n.parent else "",
+			image.name if image else "",
+			group.name if group else "",
+			image_base_exists,
+			group_base_exists,
+			tuple(i.hide for i in n.inputs),
+			tuple(o.hide for o in n.outputs)))
+	for l in node_tree.links:
+		data.append((l.from_node.name, l.from_socket.identifier, l.to_node.name, l.to_socket.identifier))
+	return hashlib.sha1(repr(data).encode()).hexdigest()
+
+def clean_node_tree_cached(node_tree, done=None, dry_run=False, **options):
+	""" Clean up a node tree with clean_node_tree(), unless it didn't change since it was last cleaned up with the same options, or it was already done during this run.
+	done: Set of node tree pointers that were already handled during this run. Shared node groups only need to be visited once.
+	dry_run: Only count the nodes that would be removed.
+	Returns the number of removed nodes.
+	"""
+	if(done is not None):
+		if(node_tree.as_pointer() in done): return 0
+		done.add(node_tree.as_pointer())
+
+	if(node_tree.get(node_tree_hash_prop) == get_node_tree_hash(node_tree, options)): return 0
+
+	removed_count = clean_node_tree(node_tree, dry_run=dry_run, **options)
+	if(not dry_run):
+		node_tree[node_tree_hash_prop] = get_node_tree_hash(node_tree, options)
+	return removed_count
+
+def clean_up_material(m, fix_name=False, delete_unused_nodes=False, fix_groups=True, fix_tex_refs=True, rename_tex_nodes=False, hide_sockets=False, tex_width=400, dry_run=False):
+	""" Fix the name of a material and clean up its node tree. The defaults match those of CleanUpMaterials.
+	Returns the number of removed nodes. With dry_run, they are only counted.
+	"""
+	if(fix_name and not dry_run):
+		# Clearing .00x from end of names
+		if(('.' in m.name) and (m.name[-4] == '.')):
+			existing = bpy.data.materials.get(m.name[:-4])
+			if(not existing):
+				m.name = m.name[:-4]
+				print("...Renamed to " + m.name)
+	# Cleaning nodetree
+	if(not m.use_nodes): return 0
+	return clean_node_tree_cached(m.node_tree, 
+		dry_run=dry_run, 
+		delete_unused_nodes=delete_unused_nodes, 
+		fix_groups=fix_groups, 
+		center_nodes=True, 
+		fix_tex_refs=fix_tex_refs, 
+		rename_tex_nodes=rename_tex_nodes, 
+		hide_sockets=hide_sockets, 
+		min_sockets=2, 
+		tex_width=tex_width)
+
+node_setting_props = {}
+"""Identifiers of the properties that are specific to a type of node, by key: RNA type identifier."""
+
+def get_node_setting_props(node):
+	""" Return the identifiers of the properties of node's type that affect its output, e.g. blend_type or image, as opposed to name or location. Each RNA type is only introspected once. """
+	key = node.bl_rna.identifier
+	props = node_setting_props.get(key)
+	if(props is None):
+		base_props = {p.identifier for p in bpy.types.Node.bl_rna.properties}
+		props = tuple(p.identifier for p in node.bl_rna.properties if p.identifier not in base_props and p.type in {'BOOLEAN', 'INT', 'FLOAT', 'STRING', 'ENUM', 'POINTER', 'COLLECTION'})
+		node_setting_props[key] = props
+	return props
+
+hashable_structs = {'ColorRamp', 'ColorRampElement', 'CurveMapping', 'CurveMap', 'CurveMapPoint', 'ColorMapping', 'TexMapping', 'ImageUser'}
+"""RNA type identifiers of the non-ID structs on nodes that get_value_key() serializes property by property, e.g. the elements of a color ramp or the points of a curve."""
+
+def get_value_key(value):
+	""" Return a hashable representation of a property value. IDs are represented by their name, and floats are rounded so that float noise doesn't count as a difference.
+	Raises ValueError for structs that aren't in hashable_structs, since two values that can't be told apart mustn't be considered equal.
+	"""
+	if(isinstance(value, bpy.types.ID)):
+		return value.name
+	if(isinstance(value, bpy.types.bpy_struct)):
+		identifier = value.bl_rna.identifier
+		if(identifier not in hashable_structs):
+			raise ValueError("Can't hash a struct of type " + identifier)
+		return get_struct_key(value)
+	if(isinstance(value, float)):
+		return round(value, 5)
+	if(value is None or isinstance(value, (str, int, bool))):
+		return value
+	if(isinstance(value, set)):	# Enum flags
+		return tuple(sorted(value))
+	# Vectors, colors, arrays and collections.
+	return tuple(get_value_key(v) for v in value)
+
+def get_struct_key(struct):
+	""" Return a hashable representation of all properties of a struct, e.g. the Cycles settings of a material. """
+	return (struct.bl_rna.identifier, tuple((p.identifier, get_value_key(getattr(struct, p.identifier))) for p in struct.bl_rna.properties if p.identifier != 'rna_type'))
+
+def get_id_props_key(datablock):
+	""" Return a hashable representation of the custom properties of a datablock. """
+	items = []
+	for key in sorted(datablock.keys()):
+		value = datablock[key]
+		if(hasattr(value, 'to_dict')):
+			value = value.to_dict()
+		elif(hasattr(value, 'to_list')):
+			value = value.to_list()
+		items.append((key, repr(value)))
+	return tuple(items)
+
+def get_material_hash(material):
+	""" Return a hash of the material's settings and node graph that doesn't depend on the names or locations of the nodes, or None if the material can't be safely compared to others.
+	Each node is hashed together with the hashes of the nodes plugged into it, starting from the material and AOV output nodes, so nodes that aren't connected to an output don't count.
+	Animated materials, grease pencil materials, and materials with node settings that can't be hashed, return None.
+	"""
+	# The stroke and fill settings of grease pencil materials aren't part of the hash.
+	if(getattr(material, 'is_grease_pencil', False)):
+		return None
+	node_tree = material.node_tree if material.use_nodes else None
+	# Keyframes and drivers can make otherwise identical materials differ.
+	if(material.animation_data or (node_tree and node_tree.animation_data)):
+		return None
+
+	try:
+		settings = [get_value_key(getattr(material, attr, None)) for attr in ['use_nodes', 'blend_method', 'shadow_method', 'alpha_threshold', 'use_backface_culling', 'show_transparent_back', 'use_screen_refraction', 'refraction_depth', 'use_sss_translucency', 'pass_index', 'diffuse_color', 'specular_color', 'metallic', 'roughness', 'specular_intensity', 'line_color', 'line_priority']]
+		# Render engine settings added by add-ons, e.g. the displacement method of Cycles, and custom properties.
+		if(hasattr(material, 'cycles')):
+			settings.append(get_struct_key(material.cycles))
+		settings.append(get_id_props_key(material))
+		if(not node_tree):
+			return hashlib.sha1(repr(settings).encode()).hexdigest()
+
+		incoming = {}	# Sockets plugged into each input socket, by key: (node name, socket identifier).
+		for l in node_tree.links:
+			if(getattr(l, 'is_muted', False)): continue
+			incoming.setdefault((l.to_node.name, l.to_socket.identifier), []).append((l.from_node, l.from_socket.identifier))
+
+		node_keys = {}	# Hash of each visited node, by key: node name.
+		def get_node_key(node):
+			key = node_keys.get(node.name)
+			if(key is None):
+				inputs = []
+				for i in node.inputs:
+					links = incoming.get((node.name, i.identifier))
+					if(links):
+						inputs.append((i.identifier, sorted((get_node_key(from_node), from_socket) for from_node, from_socket in links)))
+					else:
+						inputs.append((i.identifier, get_value_key(getattr(i, 'default_value', None))))
+				data = (node.bl_idname, node.mute, [get_value_key(getattr(node, attr)) for attr in get_node_setting_props(node)], inputs)
+				key = hashlib.sha1(repr(data).encode()).hexdigest()
+				node_keys[node.name] = key
+			return key
+
+		outputs = sorted(get_node_key(n) for n in node_tree.nodes if n.type in {'OUTPUT_MATERIAL', 'OUTPUT_AOV'})
+	except ValueError as e:
+		print("Not merging material %s: %s" %(material.name, e))
+		return None
+	return hashlib.sha1(repr((settings, outputs)).encode()).hexdigest()
+
+def count_shaders():
+	""" Return the number of materials that are in use, each of which is a separate shader to compile. """
+	return len([m for m in bpy.data.materials if m.users - int(m.use_fake_user) > 0])
+
+def merge_duplicate_materials(materials=None, remove=True, dry_run=False):
+	""" Replace all users of materials that have the same settings and node graph with a single one of them, using ID.user_remap().
+	The material with the shortest name is kept, so Material is preferred over Material.001.
+	remove: Remove the merged materials afterwards.
+	dry_run: Only count the materials that would be merged.
+	Returns the number of merged materials, and the number of shaders before and after.
+	"""
+	if(materials is None):
+		materials = bpy.data.materials
+	shaders_before = count_shaders()
+
+	# Linked materials can't be remapped or removed.
+	groups = {}
+	for m in materials:
+		if(m.library): continue
+		material_hash = get_material_hash(m)
+		if(material_hash is None): continue
+		groups.setdefault(material_hash, []).append(m)
+
+	merged_count = 0
+	for group in groups.values():
+		if(len(group) < 2): continue
+		group.sort(key=lambda m: (len(m.name), m.name))
+		keep = group[0]
+		for m in group[1:]:
+			merged_count += 1
+			if(dry_run): continue
+			m.user_remap(keep)
+			if(remove):
+				bpy.data.materials.remove(m)
+
+	shaders_after = count_shaders() if not dry_run else shaders_before - merged_count
+	return merged_count, shaders_before, shaders_after
+
+class MergeDuplicateMaterials(bpy.types.Operator):
+	""" Merge materials that have identical settings and node graphs, regardless of their names. """
+	bl_idname = "material.merge_duplicates"
+	bl_label = "Merge Duplicate Materials"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	opt_remove: BoolProperty(name="Remove Duplicates",
+		default=True,
+		description="Remove the materials that were merged into another one, rather than leaving them with no users")
+
+	def execute(self, context):
+		merged_count, shaders_before, shaders_after = merge_duplicate_materials(remove=self.opt_remove)
+		self.report({'INFO'}, "Merged %d materials. Shaders: %d -> %d" %(merged_count, shaders_before, shaders_after))
+		return {'FINISHED'}
+
+image_file_hashes = {}
+"""Size and content digest of image files, by key: absolute file path. Along with the modification time when they were hashed, so files are only read again when they change."""
+
+def get_image_file_hash(filepath):
+	""" Return the size and content digest of a file, or None if it can't be read. Results are cached until the file's modification time changes. """
+	try:
+		stat = os.stat(filepath)
+	except OSError:
+		return None
+	cached = image_file_hashes.get(filepath)
+	if(cached and cached[0] == stat.st_mtime):
+		return cached[1]
+
+	digest = hashlib.blake2b()
+	with open(filepath, 'rb') as f:
+		for chunk in iter(lambda: f.read(1<<20), b''):
+			digest.update(chunk)
+	file_hash = (stat.st_size, digest.hexdigest())
+	image_file_hashes[filepath] = (stat.st_mtime, file_hash)
+	return file_hash
+
+def get_image_hash(image):
+	""" Return a key that is equal for images that load the same pixels with the same settings, or None if the image isn't loaded from a file, or has unsaved changes. """
+	# The pixels of a dirty image, e.g. after texture painting, differ from its file, and merging would lose them.
+	if(image.source != 'FILE' or image.library or image.is_dirty): return None
+	if(image.packed_file):
+		file_hash = (image.packed_file.size, hashlib.blake2b(image.packed_file.data).hexdigest())
+	else:
+		file_hash = get_image_file_hash(os.path.normpath(bpy.path.abspath(image.filepath)))
+	if(file_hash is None): return None
+	return (file_hash, image.colorspace_settings.name, image.alpha_mode)
+
+def get_image_memory(image):
+	""" Return an estimate of the memory used by the image's pixels once loaded. """
+	width, height = image.size
+	return width * height * image.channels * (4 if image.is_float else 1)
+
+def merge_duplicate_images(images=None, remove=True, dry_run=False):
+	""" Replace all users of images that load the same file contents with a single one of them, using ID.user_remap().
+	The image with the shortest name is kept. Files are compared by size and content digest, so the same file loaded from different paths or under different names counts as a duplicate.
+	remove: Remove the merged images afterwards.
+	dry_run: Only count the images that would be merged.
+	Returns the number of merged images, and an estimate of the reclaimed memory in bytes.
+	"""
+	if(images is None):
+		images = bpy.data.images
+
+	groups = {}
+	for img in images:
+		key = get_image_hash(img)
+		if(key is not None):
+			groups.setdefault(key, []).append(img)
+
+	merged_count = 0
+	reclaimed_bytes = 0
+	for group in groups.values():
+		if(len(group) < 2): continue
+		group.sort(key=lambda img: (len(img.name), img.name))
+		keep = group[0]
+		for img in group[1:]:
+			merged_count += 1
+			# Only images that were loaded actually take up memory.
+			if(img.has_data):
+				reclaimed_bytes += get_image_memory(img)
+			if(dry_run): continue
+			img.user_remap(keep)
+			if(remove):
+				bpy.data.images.remove(img)
+
+	return merged_count, reclaimed_bytes
+
+class MergeDuplicateImages(bpy.types.Operator):
+	""" Merge images that load the same file contents, regardless of their names and file paths. """
+	bl_idname = "image.merge_duplicates"
+	bl_label = "Merge Duplicate Images"
+	bl_options = {'REGISTER', 'UNDO'}
+
+	opt_remove: BoolProperty(name="Remove Duplicates",
+		default=True,
+		description="Remove the images that were merged into another one, rather than leaving them with no users")
+
+	def execute(self, context):
+		merged_count, reclaimed_bytes = merge_duplicate_images(remove=self.opt_remove)
+		self.report({'INFO'}, "Merged %d images, reclaiming %.1f MB." %(merged_count, reclaimed_bytes / (1<<20)))
+		return {'FINISHED'}
+
 class CleanUpArmature(bpy.types.Operator):
 	# TODO: turn into a valid operator
 	# TODO: disable Deform tickbox on bones with no corresponding vgroups. (This would ideally be done before vgroup cleanup) - Always print a warning for this.
@@ -352,7 +835,7 @@ class CleanUpMaterials(bpy.types.Operator):
 	# TODO: Can be added to the UI the same place as delete unused material slots.
 
 	def execute(self, context):
-		mats_done = []
+		mats_done = set()
 		
 		objs = context.selected_objects
 		if(self.opt_objects=='Active'):
@@ -364,27 +847,126 @@ class CleanUpMaterials(bpy.types.Operator):
 			for ms in o.material_slots:
 				m = ms.material
 				if(m==None or m in mats_done): continue
-				if(self.opt_fix_name):
-					# Clearing .00x from end of names
-					if(('.' in m.name) and (m.name[-4] == '.')):
-						existing = bpy.data.materials.get(m.name[:-4])
-						if(not existing):
-							m.name = m.name[:-4]
-							print("...Renamed to " + m.name)
-				# Cleaning nodetree
-				if(m.use_nodes):
-					clean_node_tree(m.node_tree, 
+				clean_up_material(m, 
+					fix_name=self.opt_fix_name, 
 					delete_unused_nodes=self.opt_delete_unused_nodes, 
 					fix_groups=self.opt_fix_groups, 
-					center_nodes=True, 
 					fix_tex_refs=self.opt_fix_tex_refs, 
 					rename_tex_nodes=self.opt_rename_nodes, 
 					hide_sockets=self.opt_hide_sockets, 
-					min_sockets=2, 
 					tex_width=self.opt_set_tex_widths)
-				mats_done.append(m)
+				mats_done.add(m)
 		return {'FINISHED'}
 
+def clean_up_objects(context, objs, report, rename_data=True, rename_uvs=True, clean_material_slots=True, rename_materials=False, clean_materials=False, clean_vgroups=True, create_mirror_vgroups=True):
+	""" Clean up meshes and armatures in a single pass over the objects, without changing the active object. The defaults match those of CleanUpObjects.
+	Timings and counts are added to the stages of the CleanUpReport. With report.dry_run, nothing is changed, only counted.
+	"""
+	dry_run = report.dry_run
+	with report.stage('objects'):
+		objs = [obj for obj in objs if type(obj) == bpy.types.Object and obj.type in ['MESH', 'ARMATURE']]
+
+		# Changes made through the data API while in edit mode would be lost when leaving it.
+		if(not dry_run and context.object and context.object.mode != 'OBJECT'):
+			bpy.ops.object.mode_set(mode='OBJECT')
+
+		# Sorting vertex groups by hierarchy. There is no data API for reordering vertex groups, but the operator can be pointed at the objects without making them active.
+		if(not dry_run):
+			run_on_objects(bpy.ops.object.vertex_group_sort, [obj for obj in objs if obj.type == 'MESH' and len(obj.vertex_groups) > 1], sort_type='BONE_HIERARCHY')
+
+	with report.stage('material_slots'):
+		# Users of each mesh, so that material slots of shared meshes are cleaned once, for all of its users at the same time.
+		mesh_users = {}
+		if(clean_material_slots):
+			for o in bpy.data.objects:
+				if(o.type=='MESH'):
+					mesh_users.setdefault(o.data, []).append(o)
+		meshes_done = set()
+	mats_done = set()
+
+	with report.stage('vgroups'):
+		if(clean_vgroups):
+			references = VGroupReferenceIndex(objs)
+			kinds = {'MODIFIER', 'BONE', 'SHAPE_KEY', 'CONSTRAINT'}
+			# Like the sorting, before anything is changed through the data API.
+			if(not dry_run):
+				clean_zero_weights(objs)
+	
+	for obj in objs:
+		with report.stage('objects') as stage:
+			stage['objects'] += 1
+			if(not dry_run):
+				clean_up_object(obj, rename_data, rename_uvs, create_mirror_vgroups)
+
+		if(obj.type == 'ARMATURE'):
+			continue
+
+		# Deleting unused material slots
+		with report.stage('material_slots') as stage:
+			if(clean_material_slots and obj.data not in meshes_done and len(obj.data.polygons) > 0):
+				stage['objects'] += 1
+				stage['removed_slots'] += remove_unused_material_slots(obj.data, mesh_users[obj.data], dry_run)
+				meshes_done.add(obj.data)
+
+		# Cleaning node trees
+		with report.stage('materials') as stage:
+			for ms in obj.material_slots:
+				m = ms.material
+				if(m==None or m in mats_done): continue
+				stage['removed_nodes'] += clean_up_material(m, 
+					fix_name=rename_materials, 
+					delete_unused_nodes=clean_materials, 
+					fix_groups=clean_materials, 
+					fix_tex_refs=clean_materials, 
+					rename_tex_nodes=clean_materials, 
+					dry_run=dry_run)
+				mats_done.add(m)
+
+		with report.stage('vgroups') as stage:
+			if(clean_vgroups and len(obj.vertex_groups) > 0):
+				stage['objects'] += 1
+				stage['removed_groups'] += delete_unused_vgroups(obj, references, kinds, dry_run=dry_run)
+
+def clean_up_object(obj, rename_data=True, rename_uvs=True, create_mirror_vgroups=True):
+	""" Rename the data, collapse constraints and modifiers, and create the vertex groups needed by Mirror modifiers. Vertex groups are sorted separately by clean_up_objects(). """
+	# Naming mesh/skeleton data blocks
+	if(rename_data):
+		obj.data.name = "Data_" + obj.name
+	
+	# Closing and naming object constraints
+	for c in obj.constraints:
+		c.show_expanded = False
+		if(c.type=='ACTION'):
+			c.name = "Action_" + c.action.name
+	
+	# Closing modifiers
+	for m in obj.modifiers:
+		m.show_expanded = False
+
+	# That's it for armatures.
+	if(obj.type == 'ARMATURE'):
+		return
+	
+	# Wireframes
+	obj.show_wire = False
+	obj.show_all_edges = True
+
+	# Renaming UV map if there is only one
+	if(rename_uvs):
+		if(len(obj.data.uv_layers) == 1):
+			obj.data.uv_layers[0].name = "UVMap"
+	
+	# Creating missing vertex groups for Mirror modifier
+	if(create_mirror_vgroups):
+		for m in obj.modifiers:
+			if(m.type=='MIRROR'):
+				vgs = obj.vertex_groups
+				for name in [vg.name for vg in vgs]:
+					flippedName = utils.flip_name(name)
+					if(flippedName not in vgs):
+						obj.vertex_groups.new(name=flippedName)
+				break
+
 class CleanUpObjects(bpy.types.Operator):
 	bl_idname = "object.clean_up"
 	bl_label = "Clean Up Objects"
@@ -432,80 +1014,23 @@ class CleanUpObjects(bpy.types.Operator):
 		description="If there is a Mirror modifier, create any missing left/right sided vertex groups")
 
 	def execute(self, context):
-		org_active = context.object
-
 		objs = context.selected_objects
 		if(self.opt_objects=='Active'):
 			objs = [context.object]
 		elif(self.opt_objects=='All'):
 			objs = bpy.data.objects
-		
-		for obj in objs:
-			if(type(obj) != bpy.types.Object or 
-			(obj.type != 'MESH' and 
-			obj.type != 'ARMATURE') ): continue
-
-			bpy.ops.object.mode_set(mode="OBJECT")
-			bpy.context.view_layer.objects.active = obj
-			
-			# Naming mesh/skeleton data blocks
-			if(self.opt_rename_data):
-				obj.data.name = "Data_" + obj.name
-			
-			# Closing and naming object constraints
-			for c in obj.constraints:
-				c.show_expanded = False
-				if(c.type=='ACTION'):
-					c.name = "Action_" + c.action.name
-			
-			# Closing modifiers
-			for m in obj.modifiers:
-				m.show_expanded = False
-
-			# That's it for armatures.
-			if(obj.type == 'ARMATURE'):
-				continue
-			
-			# Wireframes
-			obj.show_wire = False
-			obj.show_all_edges = True
 
-			# Sorting vertex groups by hierarchy
-			bpy.ops.object.vertex_group_sort(sort_type='BONE_HIERARCHY')
-
-			# Renaming UV map if there is only one
-			if(self.opt_rename_uvs):
-				if(len(obj.data.uv_layers) == 1):
-					obj.data.uv_layers[0].name = "UVMap"
-			
-			# Creating missing vertex groups for Mirror modifier
-			if(self.opt_create_mirror_vgroups):
-				for m in obj.modifiers:
-					if(m.type=='MIRROR'):
-						vgs = obj.vertex_groups
-						for vg in vgs:
-							flippedName = utils.flip_name(vg.name)
-							print(flippedName)
-							if(flippedName not in vgs):
-								obj.vertex_groups.new(name=flippedName)
-						break
-				
-		# Deleting unused material slots
-		if(self.opt_clean_material_slots):
-			bpy.ops.object.delete_unused_material_slots(opt_objects=self.opt_objects)
-
-		# Cleaning node trees
-		bpy.ops.material.clean_up(opt_objects=self.opt_objects, 
-			opt_fix_name=self.opt_rename_materials, 
-			opt_delete_unused_nodes=self.opt_clean_materials, 
-			opt_fix_groups=self.opt_clean_materials, 
-			opt_fix_tex_refs=self.opt_clean_materials, 
-			opt_rename_nodes=self.opt_clean_materials)
-
-		if(self.opt_clean_vgroups):
-			bpy.ops.object.delete_unused_vgroups(opt_objects=self.opt_objects)
-		
-		bpy.context.view_layer.objects.active = org_active
+		report = CleanUpReport()
+		clean_up_objects(context, objs, report, 
+			rename_data=self.opt_rename_data, 
+			rename_uvs=self.opt_rename_uvs, 
+			clean_material_slots=self.opt_clean_material_slots, 
+			rename_materials=self.opt_rename_materials, 
+			clean_materials=self.opt_clean_materials, 
+			clean_vgroups=self.opt_clean_vgroups, 
+			create_mirror_vgroups=self.opt_create_mirror_vgroups)
+
+		self.report({'INFO'}, "Cleaned up %d objects in %.3f seconds." %(report.total('objects'), report.total('seconds')))
 		return {'FINISHED'}
 
 class CleanUpScene(bpy.types.Operator):
@@ -562,36 +1087,124 @@ class CleanUpScene(bpy.types.Operator):
 		default=True,
 		description="Remove unused nodes, resize and rename image nodes, hide unused group node sockets, and center nodes")
 
+	opt_merge_materials: BoolProperty(
+		name="Merge Duplicate Materials",
+		default=False,
+		description="Merge materials that have identical settings and node graphs, regardless of their names")
+
+	opt_merge_images: BoolProperty(
+		name="Merge Duplicate Images",
+		default=False,
+		description="Merge images that load the same file contents, regardless of their names and file paths")
+
+	opt_dry_run: BoolProperty(
+		name="Dry Run",
+		default=False,
+		description="Only count what would be removed, without changing anything")
+
+	opt_report_path: StringProperty(
+		name="Report File",
+		default="",
+		subtype='FILE_PATH',
+		description="Save the timings and counts of each stage to this JSON file. Leave empty to not save the report")
+
 	def execute(self, context):
+		global last_report
 		if(self.opt_freeze):
 			return {'FINISHED'}
 
-		org_active = bpy.context.view_layer.objects.active
+		report = CleanUpReport(self.opt_dry_run)
 
+		# Trees that didn't change since the last run are skipped, and each tree is only handled once per run.
+		trees_done = set()
 		if(self.opt_clean_worlds):
-			for w in bpy.data.worlds:
-				if(w.use_nodes):
-					clean_node_tree(w.node_tree)
+			with report.stage('worlds') as stage:
+				for w in bpy.data.worlds:
+					if(w.use_nodes):
+						stage['removed_nodes'] += clean_node_tree_cached(w.node_tree, trees_done, self.opt_dry_run)
 
 		if(self.opt_clean_comp):
-			for s in bpy.data.scenes:
-				if(s.use_nodes):
-					clean_node_tree(s.node_tree)
+			with report.stage('compositing') as stage:
+				for s in bpy.data.scenes:
+					if(s.use_nodes):
+						stage['removed_nodes'] += clean_node_tree_cached(s.node_tree, trees_done, self.opt_dry_run)
 		
 		if(self.opt_clean_nodegroups):
-			for nt in bpy.data.node_groups:
-				clean_node_tree(nt)
+			with report.stage('node_groups') as stage:
+				for nt in bpy.data.node_groups:
+					stage['removed_nodes'] += clean_node_tree_cached(nt, trees_done, self.opt_dry_run)
 		
-		objects = 'Selected' if self.opt_selected_only else 'All'
-		bpy.ops.object.clean_up(opt_objects=objects, 
-			opt_clean_vgroups=self.opt_clean_vgroups, 
-			opt_clean_material_slots=self.opt_clean_material_slots, 
-			opt_rename_materials=self.opt_rename_materials, 
-			opt_clean_materials=self.opt_clean_materials)
+		# Merging images first, so that materials using copies of the same image can be merged as well.
+		if(self.opt_merge_images):
+			with report.stage('merge_images') as stage:
+				merged_count, reclaimed_bytes = merge_duplicate_images(dry_run=self.opt_dry_run)
+				stage['merged_images'] += merged_count
+				stage['reclaimed_bytes'] = reclaimed_bytes
+
+		if(self.opt_merge_materials):
+			with report.stage('merge_materials') as stage:
+				merged_count, shaders_before, shaders_after = merge_duplicate_materials(dry_run=self.opt_dry_run)
+				stage['merged_materials'] += merged_count
+				stage['shaders_before'] = shaders_before
+				stage['shaders_after'] = shaders_after
+
+		objs = context.selected_objects if self.opt_selected_only else bpy.data.objects
+		clean_up_objects(context, objs, report, 
+			clean_vgroups=self.opt_clean_vgroups, 
+			clean_material_slots=self.opt_clean_material_slots, 
+			rename_materials=self.opt_rename_materials, 
+			clean_materials=self.opt_clean_materials)
 		
-		bpy.context.view_layer.objects.active = org_active
+		last_report = report
+		if(self.opt_report_path != ""):
+			filepath = bpy.path.abspath(self.opt_report_path)
+			if(bpy.data.filepath == "" and self.opt_report_path.startswith("//")):
+				# Relative paths can't be resolved before the file is saved.
+				filepath = os.path.join(bpy.app.tempdir, os.path.basename(self.opt_report_path[2:]))
+			report.save(filepath)
+			print("Clean up report saved to " + filepath)
+
+		self.report({'INFO'}, "%s %d images, %d materials, %d nodes, %d material slots and %d vertex groups in %.3f seconds." %(
+			"Would merge/remove" if self.opt_dry_run else "Merged/removed", 
+			report.total('merged_images'), report.total('merged_materials'), report.total('removed_nodes'), report.total('removed_slots'), report.total('removed_groups'), report.total('seconds')))
 		return {'FINISHED'}
 
+class CleanUpReportPanel(bpy.types.Panel):
+	""" Timings and counts of the last Clean Up Scene run. """
+	bl_idname = "SCENE_PT_clean_up_report"
+	bl_label = "Clean Up Report"
+	bl_space_type = 'PROPERTIES'
+	bl_region_type = 'WINDOW'
+	bl_context = 'scene'
+	bl_options = {'DEFAULT_CLOSED'}
+
+	@classmethod
+	def poll(cls, context):
+		return last_report is not None
+
+	def draw(self, context):
+		layout = self.layout
+		if(last_report.dry_run):
+			layout.label(text="Dry run, nothing was changed.", icon='INFO')
+		merge_stage = last_report.stages.get('merge_materials')
+		if(merge_stage):
+			layout.label(text="Shaders: %d -> %d" %(merge_stage['shaders_before'], merge_stage['shaders_after']))
+		merge_stage = last_report.stages.get('merge_images')
+		if(merge_stage):
+			layout.label(text="Image memory reclaimed: %.1f MB" %(merge_stage['reclaimed_bytes'] / (1<<20)))
+
+		columns = ['seconds'] + CleanUpReport.counters
+		row = layout.row()
+		row.label(text="Stage")
+		for c in columns:
+			row.label(text=c.replace("_", " ").title())
+		for name, stage in list(last_report.stages.items()) + [("Total", {c : last_report.total(c) for c in columns})]:
+			row = layout.row()
+			row.label(text=name.replace("_", " ").title())
+			row.label(text="%.3f" %stage['seconds'])
+			for c in CleanUpReport.counters:
+				row.label(text=str(stage[c]))
+
 def register():
 	from bpy.utils import register_class
 	bpy.types.MATERIAL_MT_context_menu.prepend(DeleteUnusedMaterialSlots.draw)
@@ -603,17 +1216,23 @@ def register():
 	#register_class(CleanUpMeshes)
 	#register_class(CleanUpArmatures)
 	register_class(CleanUpMaterials)
+	register_class(MergeDuplicateMaterials)
+	register_class(MergeDuplicateImages)
 	register_class(CleanUpScene)
+	register_class(CleanUpReportPanel)
 
 def unregister():
 	bpy.types.MATERIAL_MT_context_menu.remove(DeleteUnusedMaterialSlots.draw)
-	bpy.types.TOPBAR_MT_file_import.remove(DeleteUnusedVGroups.draw_delete_unused)
-	bpy.types.TOPBAR_MT_file_import.remove(DeleteUnusedVGroups.draw_delete_empty)
+	bpy.types.MESH_MT_vertex_group_context_menu.remove(DeleteUnusedVGroups.draw_delete_unused)
+	bpy.types.MESH_MT_vertex_group_context_menu.remove(DeleteUnusedVGroups.draw_delete_empty)
 	from bpy.utils import unregister_class
-	unregister_class(DeleteUnusedMaterialSlots)
-	unregister_class(DeleteUnusedVGroups)
-	unregister_class(CleanUpObjects)
-	#unregister_class(CleanUpMeshes)
-	#unregister_class(CleanUpArmatures)
+	unregister_class(CleanUpReportPanel)
+	unregister_class(CleanUpScene)
+	unregister_class(MergeDuplicateImages)
+	unregister_class(MergeDuplicateMaterials)
 	unregister_class(CleanUpMaterials)
-	unregister_class(CleanUpScene)
\ No newline at end of file
+	#unregister_class(CleanUpArmatures)
+	#unregister_class(CleanUpMeshes)
+	unregister_class(CleanUpObjects)
+	unregister_class(DeleteUnusedVGroups)
+	unregister_class(DeleteUnusedMaterialSlots)
@@ -30,10 +30,11 @@ bl_info = {
 
 # TODO: make this compatible with 2.8.
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 import bpy
 import bmesh
+import numpy as np
 from bpy.props import BoolProperty,BoolProperty
 from mathutils import kdtree
 
@@ -86,33 +87,101 @@ class TransferVertId(bpy.types.Operator):
         TargetObjs = [obj for obj in context.selected_objects if obj!=sourceObj and obj.type=='MESH']
 
         mesh = sourceObj.data
-        size = len(mesh.vertices)
-        kdSourceObj = kdtree.KDTree(size)
+        sourceCos = get_vert_coords(mesh)
+        kdSourceObj = None  # Only built when some verts can't be matched through the spatial hash.
 
-        for i, v in enumerate(mesh.vertices):
-            kdSourceObj.insert(v.co, i)
-
-        kdSourceObj.balance()
         preocessedVertsIdDict = {}
         for target in TargetObjs:
-            copiedCount = 0
             preocessedVertsIdDict.clear()
+            targetCos = get_vert_coords(target.data)
+            matches = find_matching_verts(sourceCos, targetCos, self.delta)
+
+            # Verts that moved, lie close to a cell border, or share a crowded cell are found with the KD tree.
+            unmatched = np.flatnonzero(matches == -1) if self.delta > 0 else []
+            if len(unmatched) > 0 and kdSourceObj is None:
+                kdSourceObj = kdtree.KDTree(len(mesh.vertices))
+                for i, v in enumerate(mesh.vertices):
+                    kdSourceObj.insert(v.co, i)
+                kdSourceObj.balance()
+            for i in unmatched:
+                co, index, dist = kdSourceObj.find(targetCos[i].tolist())
+                if dist<self.delta:  #delta
+                    matches[i] = index
+
             bm = bmesh.new()  # load mesh
             bm.from_mesh(target.data)
-            for targetVert in bm.verts:
-                co, index, dist = kdSourceObj.find(targetVert.co)
-                if dist<self.delta:  #delta
-                    copiedCount+=1
-                    targetVert.index = index
-                    preocessedVertsIdDict[targetVert]=index
+            bm.verts.ensure_lookup_table()
+            bm.verts.index_update()
+            matched = np.flatnonzero(matches != -1)
+            for i, index in zip(matched.tolist(), matches[matched].tolist()):
+                targetVert = bm.verts[i]
+                targetVert.index = index
+                preocessedVertsIdDict[targetVert]=index
             PasteVertID.sortOtherVerts(preocessedVertsIdDict, bm.verts)
             bm.verts.sort()
             bm.to_mesh(target.data)
             bm.free()
-            self.report({'INFO'}, 'Pasted '+str(copiedCount)+' vert id\'s ')
+            self.report({'INFO'}, 'Pasted '+str(len(matched))+' vert id\'s ')
         return {"FINISHED"}
 
 
+def get_vert_coords(mesh):
+    """ Returns the vertex coordinates of a mesh as an (n, 3) array. """
+    coords = np.empty(len(mesh.vertices)*3, dtype=np.float32)
+    mesh.vertices.foreach_get('co', coords)
+    return coords.reshape(-1, 3)
+
+def find_matching_verts(source_co, target_co, delta, max_cell_verts=8):
+    """ Matches target verts to the nearest source vert within delta, using a spatial hash for verts that have (nearly) the same position.
+    The cells of the hash are only a few float steps wide, so they are independent of delta, which stays the search distance.
+    Returns the source index for each target vert, or -1 where the hash can't tell the nearest vert for sure.
+    A match is only accepted when the nearest source vert in the target's cell is closer than the cell's borders,
+    so no source vert in a neighbouring cell can be any closer. Cells with more than max_cell_verts source verts are left to the KD tree.
+    """
+    matches = np.full(len(target_co), -1, dtype=np.int64)
+    if delta <= 0 or len(source_co) == 0 or len(target_co) == 0:
+        return matches
+
+    # Single precision coordinates have 24 bits of mantissa, so cells 2^-20 times the largest coordinate are a few float steps wide.
+    magnitude = max(np.abs(source_co).max(), np.abs(target_co).max())
+    cell_size = magnitude * 2.0**-20 if magnitude > 0 else 1.0
+    source_grid = source_co.astype(np.float64) / cell_size
+    target_grid = target_co.astype(np.float64) / cell_size
+    source_cells = np.floor(source_grid).astype(np.int64)
+    target_cells = np.floor(target_grid).astype(np.int64)
+
+    # Number the cells of both meshes together, so target cells can be looked up among source cells.
+    _, cell_ids = np.unique(np.concatenate((source_cells, target_cells)), axis=0, return_inverse=True)
+    cell_ids = cell_ids.ravel()
+    source_ids = cell_ids[:len(source_co)]
+    target_ids = cell_ids[len(source_co):]
+
+    # Source verts sorted by cell, so the verts of a cell are a slice.
+    cell_order = np.argsort(source_ids, kind='stable')
+    cell_counts = np.bincount(source_ids, minlength=cell_ids.max()+1)
+    cell_starts = np.cumsum(cell_counts) - cell_counts
+
+    # Pairing each target vert with every source vert in its cell.
+    counts = cell_counts[target_ids]
+    found = np.flatnonzero((counts > 0) & (counts <= max_cell_verts))
+    lengths = counts[found]
+    pair_targets = np.repeat(found, lengths)
+    pair_entries = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(cell_starts[target_ids[found]], lengths)
+    pair_sources = cell_order[pair_entries]
+    pair_dists = np.linalg.norm(target_grid[pair_targets] - source_grid[pair_sources], axis=1)
+
+    # The nearest source vert of each target vert, the lowest index on ties.
+    order = np.lexsort((pair_sources, pair_dists, pair_targets))
+    first = order[np.flatnonzero(np.diff(pair_targets[order], prepend=-1))]
+    best_targets, best_sources, best_dists = pair_targets[first], pair_sources[first], pair_dists[first]
+
+    frac = target_grid[best_targets] - target_cells[best_targets]
+    border_dists = np.minimum(frac, 1 - frac).min(axis=1)
+    valid = (best_dists * cell_size < delta) & (best_dists <= border_dists)
+    matches[best_targets[valid]] = best_sources[valid]
+    return matches
+
+
 class CopyVertID(bpy.types.Operator):
     """
         CopyVertID
@@ -170,18 +239,31 @@ class PasteVertID(bpy.types.Operator):
 
     @staticmethod
     def sortOtherVerts(preocessedVertsIdDict, allVerts):
-        """Prevet verts on other islands from being all shuffled"""
-        processedVerts = [v for v in preocessedVertsIdDict.keys()]  # faster that for dict.keys()
-        processedIDs = [id for id in preocessedVertsIdDict.values()]
-        notProcessedVerts = [v for v in allVerts if v not in processedVerts]
-        notProcessedVertsIds = [v.index for v in allVerts if
-                                v not in processedVerts]  # it will have duplicated ids from processedIDs that have to be
-        # fixed. The rest of numbers are good as ids.
-
-        spareIDS = [i for i in range(len(allVerts)) if (i not in processedIDs and i not in notProcessedVertsIds)]
+        """Prevet verts on other islands from being all shuffled.
+        Not processed verts keep their index, unless it is already taken by a processed vert, in which case they get the lowest free index."""
+        vertCount = len(allVerts)
+        processedIDs = set(preocessedVertsIdDict.values())
+        notProcessedVerts = [v for v in allVerts if v not in preocessedVertsIdDict]
+
+        # ids that are neither taken by processed verts nor held by not processed verts are free to use.
+        usedIDs = [False] * vertCount
+        for id in processedIDs:
+            if 0 <= id < vertCount:
+                usedIDs[id] = True
+        for v in notProcessedVerts:
+            if 0 <= v.index < vertCount:
+                usedIDs[v.index] = True
+        spareIDs = deque(i for i, used in enumerate(usedIDs) if not used)
+
+        # When processed verts share ids there are not enough spare ids, so keep counting past the end.
+        nextID = max(processedIDs | {vertCount - 1}) + 1
         for v in notProcessedVerts:
             if v.index in processedIDs:  # if duplicated id found if not processed verts
-                v.index = spareIDS.pop(0)  # what if list is empty??
+                if spareIDs:
+                    v.index = spareIDs.popleft()
+                else:
+                    v.index = nextID
+                    nextID += 1
 
     def execute(self, context):
         props = context.scene.copy_indices.transuv
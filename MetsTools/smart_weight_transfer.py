@@ -12,118 +12,487 @@ import bpy
 import mathutils
 from mathutils import Vector
 import math
+import os
+import multiprocessing
+import weakref
+import numpy as np
 from bpy.props import *
+from bpy.app.handlers import persistent
+from . import utils
 
-def build_weight_dict(obj, vgroups=None, mask_vgroup=None, bone_combine_dict=None):
-	""" Builds and returns a dictionary that matches the vertex indicies of the object to a list of tuples containing the vertex group names that the vertex belongs to, and the weight of the vertex in that group.
-		vgroups: If passed, skip groups that aren't in vgroups.
-		bone_combine_dict: Can be specified if we want some bones to be merged into others, eg. passing in {'Toe_Main' : ['Toe1', 'Toe2', 'Toe3']} will combine the weights in the listed toe bones into Toe_Main. You would do this when transferring weights from a model of actual feet onto shoes.
+class WeightTable:
+	""" Sparse vertex weights of an object, stored as CSR-style arrays.
+		The entries of vertex i are the slice offsets[i]:offsets[i+1] of groups and weights. groups holds column indices into names.
 	"""
+	def __init__(self, names, offsets, groups, weights):
+		self.names = names			# List of vertex group names, one per column.
+		self.offsets = offsets		# int array of vertex count + 1 entry offsets.
+		self.groups = groups		# int array of the column of each entry.
+		self.weights = weights		# float array of the weight of each entry.
 	
-	weight_dict = {}	# {vert index : [('vgroup_name', vgroup_value), ...], ...}
+	def __len__(self):
+		return len(self.offsets)-1
+	
+	def has_weights(self):
+		""" Returns a boolean array of which vertices have at least one weight. """
+		return np.diff(self.offsets) > 0
 	
+	def vertex_weights(self, index):
+		""" Returns the weights of a vertex as a list of ('vgroup_name', vgroup_value) tuples, like an entry of build_weight_dict(). """
+		start, end = self.offsets[index], self.offsets[index+1]
+		return [(self.names[g], float(w)) for g, w in zip(self.groups[start:end], self.weights[start:end])]
+
+def build_group_remap(obj, vgroups, bone_combine_dict=None):
+	""" Returns the list of column names and a list that maps each vertex group index of obj to the list of columns that its weights should be added to.
+		Groups are matched by name, so vgroups may also come from a different object.
+	"""
+	names = [vg.name for vg in vgroups]
+	remap = [[] for vg in obj.vertex_groups]
+	for col, name in enumerate(names):
+		vg = obj.vertex_groups.get(name)
+		if(vg):
+			remap[vg.index].append(col)
+		
+		# Sub-vertexgroups defined in bone_combine_dict are added into the same column.
+		if(bone_combine_dict and name in bone_combine_dict):
+			for sub_vg_name in bone_combine_dict[name]:
+				sub_vg = obj.vertex_groups.get(sub_vg_name)
+				if(sub_vg):
+					remap[sub_vg.index].append(col)
+	
+	return names, remap
+
+def get_vgroup_weights(vgroup):
+	""" Returns a list with the weight of every vertex of the vertex group's object in that group, or None where the vertex is not assigned. """
+	weights = [None] * len(vgroup.id_data.data.vertices)
+	for v in vgroup.id_data.data.vertices:
+		for g in v.groups:
+			if(g.group == vgroup.index):
+				weights[v.index] = g.weight
+				break
+	return weights
+
+def build_weight_table(obj, vgroups=None, mask_vgroup=None, bone_combine_dict=None):
+	""" Builds and returns a WeightTable of the object's vertex weights, by reading each vertex's groups only once.
+		vgroups: If passed, skip groups that aren't in vgroups.
+		mask_vgroup: If passed, weights are multiplied by the weight of the vertex with the same index in this group.
+		bone_combine_dict: Can be specified if we want some bones to be merged into others, eg. passing in {'Toe_Main' : ['Toe1', 'Toe2', 'Toe3']} will combine the weights in the listed toe bones into Toe_Main. You would do this when transferring weights from a model of actual feet onto shoes.
+	"""
 	if(vgroups==None):
 		vgroups = obj.vertex_groups
 	
+	names, remap = build_group_remap(obj, vgroups, bone_combine_dict)
+	
+	mask = None
+	if(mask_vgroup):
+		mask = get_vgroup_weights(mask_vgroup)
+	
+	offsets = [0]
+	groups = []
+	weights = []
 	for v in obj.data.vertices:
-		# TODO: instead of looking through all vgroups we should be able to get only the groups that this vert is assigned to via v.groups[0].group which gives the group id which we can use to get the group via Object.vertex_groups[id]
-		# With this maybe it's useless altogether to save the weights into a dict? idk.
-		# Although the reason we are doing it this way is because we wanted some bones to be considered the same as others. (eg. toe bones should be considered a single combined bone)
-		for vg in vgroups:
-			w = 0
-			try:
-				w = vg.weight(v.index)
-			except:
-				pass
-			
-			# Adding the weights from any sub-vertexgroups defined in bone_combine_dict
-			if(vg.name in bone_combine_dict.keys()):
-				for sub_vg_name in bone_combine_dict[vg.name]:
-					sub_vg = obj.vertex_groups.get(sub_vg_name)
-					if(sub_vg==None): continue
-					try:
-						w = w + sub_vg.weight(v.index)
-					except RuntimeError:
-						pass
-			
+		vert_weights = {}	# {column : weight}
+		for g in v.groups:
+			for col in remap[g.group]:
+				vert_weights[col] = vert_weights.get(col, 0) + g.weight
+		
+		# Masking transfer influence
+		multiplier = None
+		if(mask and v.index < len(mask)):
+			multiplier = mask[v.index]
+		
+		for col in sorted(vert_weights.keys()):
+			w = vert_weights[col]
 			if(w==0): continue
-			
-			# Masking transfer influence
-			if(mask_vgroup):
-				try:
-					multiplier = mask_vgroup.weight(v.index)
-					w = w * multiplier
-				except:
-					pass
-			
-			# Create or append entry in the dict.
-			if(v.index not in weight_dict):
-				weight_dict[v.index] = [(vg.name, w)]
-			else:
-				weight_dict[v.index].append((vg.name, w))
+			if(multiplier is not None):
+				w = w * multiplier
+			groups.append(col)
+			weights.append(w)
+		offsets.append(len(groups))
 	
+	return WeightTable(names, 
+		np.array(offsets, dtype=np.int64), 
+		np.array(groups, dtype=np.int32), 
+		np.array(weights, dtype=np.float64))
+
+def build_weight_dict(obj, vgroups=None, mask_vgroup=None, bone_combine_dict=None):
+	""" Builds and returns a dictionary that matches the vertex indicies of the object to a list of tuples containing the vertex group names that the vertex belongs to, and the weight of the vertex in that group.
+		Same parameters as build_weight_table(), which should be preferred.
+	"""
+	table = build_weight_table(obj, vgroups, mask_vgroup, bone_combine_dict)
+	weight_dict = {}	# {vert index : [('vgroup_name', vgroup_value), ...], ...}
+	for i in np.flatnonzero(table.has_weights()):
+		weight_dict[int(i)] = table.vertex_weights(i)
 	return weight_dict
 			
-def build_kdtree(obj):
-	kd = mathutils.kdtree.KDTree(len(obj.data.vertices))
-	for i, v in enumerate(obj.data.vertices):
-		kd.insert(v.co, i)
+def get_coords(obj):
+	""" Returns the object's vertex coordinates as an (n, 3) float array. """
+	coords = np.empty(len(obj.data.vertices)*3, dtype=np.float32)
+	obj.data.vertices.foreach_get('co', coords)
+	return coords.reshape(-1, 3)
+
+def build_kdtree(obj, coords=None):
+	if(coords is None):
+		coords = get_coords(obj)
+	coords = coords.tolist()
+	kd = mathutils.kdtree.KDTree(len(coords))
+	for i, co in enumerate(coords):
+		kd.insert(co, i)
 	kd.balance()
 	return kd
 
-def smart_transfer_weights(obj_from, obj_to, weights, max_verts=30, max_dist=10, dist_multiplier=1000, ):
-	""" Smart Vertex Weight Transfer.
+def find_source_verts(kd, coords, has_weights, max_verts=30, max_dist=10, dist_multiplier=1000):
+	""" Runs the nearest neighbour lookups for all target coordinates in one pass.
 		The number of nearby verts which it searches for depends on how far the nearest vert is. (This is controlled by max_verts, max_dist and dist_multiplier)
-		This means if a very close vert is found, it won't look for any more verts.
-		If the nearest vert is quite far away(or dist_multiplier is set high), it will average the influences of a larger number few verts.
-		The averaging of the influences is also weighted by their distance, so that a vertex which is twice as far away will contribute half as much influence to the final result.
-		weights: a dictionary of vertex weights that needs to be built with build_weight_dict().
+		Returns CSR-style arrays (offsets, indices, dists) of the valid source verts of each target coordinate, sorted from closest to furthest.
 	"""
-	kd = build_kdtree(obj_from)
-	
-	for v in obj_to.data.vertices:
+	offsets = [0]
+	indices = []
+	dists = []
+	for co in coords:
 		# Finding the nearest vertex on source object
-		nearest_co, nearest_idx, nearest_dist = kd.find(v.co)
+		nearest_co, nearest_idx, nearest_dist = kd.find(co)
 
 		# Determine how many verts in total should be checked, based on the distance of the closest vert.
 		number_of_source_verts = 1 + round( pow( (nearest_dist * dist_multiplier), 2 ) )
 		number_of_source_verts = max_verts if number_of_source_verts > max_verts else number_of_source_verts
 		
-		
-		# Find the previously calculated amount of nearest verts. Save their index and distance to a list of (index, distance) tuples.
-		source_verts = []
-		
-		for(co, index, dist) in kd.find_n(v.co, number_of_source_verts):
-			if( (index not in weights) or (dist > max_dist) ):	# If the found vert doesn't have any weights OR is too far away
+		# find_n() returns the verts sorted by distance already.
+		for(found_co, index, dist) in kd.find_n(co, number_of_source_verts):
+			if( (not has_weights[index]) or (dist > max_dist) ):	# If the found vert doesn't have any weights OR is too far away
 				continue
-			source_verts.append((index, dist))
+			indices.append(index)
+			dists.append(dist)
+		offsets.append(len(indices))
+	
+	return np.array(offsets, dtype=np.int64), np.array(indices, dtype=np.int64), np.array(dists, dtype=np.float64)
+
+def expand_ranges(starts, lengths):
+	""" Returns the concatenation of range(start, start+length) for each start and length, as one array. """
+	return np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(starts, lengths)
+
+def accumulate_weights(weights, offsets, indices, dists):
+	""" Accumulates the distance-paired weights of the source verts found by find_source_verts() into a dense (targets x groups) buffer.
+		Returns the normalized weights buffer and a boolean buffer of which groups each target vert receives a weight in.
+	"""
+	target_count = len(offsets)-1
+	group_count = len(weights.names)
+	
+	# The closest vert's weights are multiplied by the farthest vert's distance, and vice versa. The 2nd closest will use the 2nd farthest, etc.
+	# Note: The magnitude of the distance vectors doesn't matter because at the end they will be normalized anyways.
+	targets = np.repeat(np.arange(target_count), np.diff(offsets))
+	pair_dists = dists[offsets[targets] + offsets[targets+1] - 1 - np.arange(len(indices))]
+	# If every found vert is exactly on top of the target vert, all distances are 0, so weight them equally instead.
+	dist_sums = np.bincount(targets, weights=dists, minlength=target_count)
+	pair_dists[dist_sums[targets] == 0] = 1
+	
+	# Expanding every found source vert into its weight entries.
+	starts = weights.offsets[indices]
+	lengths = weights.offsets[indices+1] - starts
+	entry_owners = np.repeat(np.arange(len(indices)), lengths)
+	entries = expand_ranges(starts, lengths)
+	
+	cells = targets[entry_owners] * group_count + weights.groups[entries]
+	buffer = np.bincount(cells, weights=weights.weights[entries] * pair_dists[entry_owners], minlength=target_count*group_count).astype(np.float64, copy=False).reshape(target_count, group_count)
+	assigned = np.zeros(target_count*group_count, dtype=bool)
+	assigned[cells] = True
+	assigned = assigned.reshape(target_count, group_count)
+	
+	# The sum is used to normalize the weights. This is important because otherwise the values would depend on object scale, and in the case of very small or very large objects, stuff could get culled.
+	weights_sum = buffer.sum(axis=1, keepdims=True)
+	np.divide(buffer, weights_sum, out=buffer, where=weights_sum!=0)
+	return buffer, assigned
+
+def transfer_weights(kd, weights, coords, max_verts=30, max_dist=10, dist_multiplier=1000, chunk_cells=1<<22):
+	""" Calculates the transferred weights of all target coordinates, in chunks so that the dense buffer stays below chunk_cells cells.
+		Returns sparse (rows, cols, values) arrays, where rows index into coords and cols index into weights.names.
+	"""
+	has_weights = weights.has_weights()
+	chunk_size = max(1, chunk_cells // max(1, len(weights.names)))
+	chunks = []
+	for start in range(0, len(coords), chunk_size):
+		chunk = coords[start:start+chunk_size]
+		offsets, indices, dists = find_source_verts(kd, chunk, has_weights, max_verts, max_dist, dist_multiplier)
+		buffer, assigned = accumulate_weights(weights, offsets, indices, dists)
+		chunk_rows, chunk_cols = np.nonzero(assigned)
+		chunks.append((chunk_rows + start, chunk_cols, buffer[chunk_rows, chunk_cols]))
+	
+	return concatenate_results(chunks)
+
+def concatenate_results(chunks):
+	""" Joins a list of (rows, cols, values) results of transfer_weights() into one. """
+	if(len(chunks)==0):
+		return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float64)
+	return tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+
+def write_weights(obj, names, rows, cols, values, steps=0):
+	""" Assigns sparse transferred weights to the object's vertex groups, creating them if needed.
+		Vertices that receive the same weight in a group are assigned with a single call, and groups are created in the order of the first vertex that receives them.
+		steps: If not 0, weights are rounded to multiples of 1/steps, so that each group needs at most steps+1 calls. This changes the result: weights no longer sum up to exactly 1, and tiny weights become 0 while the vertex stays in the group.
+			Transferred weights blend smoothly, so at full precision nearly every vertex needs its own call.
+	"""
+	if(len(rows)==0): return
+	
+	# Vertex groups store single precision floats, so values that are equal at that precision can share a call.
+	if(steps > 0):
+		values = np.round(values * steps) / steps
+	values = values.astype(np.float32)
+	order = np.lexsort((rows, values, cols))
+	rows, cols, values = rows[order], cols[order], values[order]
+	
+	col_starts = np.flatnonzero(np.diff(cols, prepend=-1))
+	col_ends = np.append(col_starts[1:], len(cols))
+	first_rows = np.minimum.reduceat(rows, col_starts)
+	
+	for col_idx in np.lexsort((cols[col_starts], first_rows)):
+		start, end = col_starts[col_idx], col_ends[col_idx]
+		vg_name = names[cols[start]]
+		target_vg = obj.vertex_groups.get(vg_name)
+		if(target_vg == None):
+			target_vg = obj.vertex_groups.new(name=vg_name)
+		
+		value_starts = start + np.flatnonzero(np.diff(values[start:end], prepend=np.nan))
+		value_ends = np.append(value_starts[1:], end)
+		for value_start, value_end in zip(value_starts, value_ends):
+			target_vg.add(rows[value_start:value_end].tolist(), float(values[value_start]), 'REPLACE')
+
+def find_nearest_dists(kd, coords):
+	""" Returns an array of the distance of each coordinate to the nearest vertex in the KD-tree. """
+	return np.array([kd.find(co)[2] for co in coords], dtype=np.float64)
+
+def merge_part_results(target_count, parts, part_results):
+	""" Joins the results of transferring parts of targets back into one (rows, cols, values) result per target.
+		parts: List of (target index, vertex indices, KD-tree, WeightTable, coords) tuples. The rows of a part's result index into its vertex indices, or into all verts if those are None.
+	"""
+	chunks = [[] for i in range(target_count)]
+	for part, (rows, cols, values) in zip(parts, part_results):
+		target_index, indices = part[0], part[1]
+		if(indices is not None):
+			rows = indices[rows]
+		chunks[target_index].append((rows, cols, values))
+	return [concatenate_results(target_chunks) for target_chunks in chunks]
+
+def compare_results(result, reference, group_count):
+	""" Returns the maximum and mean absolute difference between two (rows, cols, values) results with the same groups, over every weight assigned in either. """
+	keys = np.concatenate((result[0]*group_count + result[1], reference[0]*group_count + reference[1]))
+	if(len(keys)==0):
+		return 0.0, 0.0
+	values = np.concatenate((result[2], -reference[2]))
+	keys, inverse = np.unique(keys, return_inverse=True)
+	differences = np.abs(np.bincount(inverse.ravel(), weights=values, minlength=len(keys)))
+	return float(differences.max()), float(differences.mean())
+
+def build_mirror_map(coords, tolerance=0.0001):
+	""" Finds the mirror partner on the +X side of each vert on the -X side.
+		Returns an array of the -X verts that have a partner within the tolerance, and an array of their partners.
+	"""
+	kd = build_kdtree(None, coords)
+	mirrored = []
+	partners = []
+	for i in np.flatnonzero(coords[:, 0] < -tolerance):
+		x, y, z = coords[i].tolist()
+		co, index, dist = kd.find((-x, y, z))
+		if(dist <= tolerance):
+			mirrored.append(i)
+			partners.append(index)
+	return np.array(mirrored, dtype=np.int64), np.array(partners, dtype=np.int64)
+
+def get_flipped_names(names):
+	""" Returns the list of names extended with the flipped names that aren't in it yet, and an array that maps each name's index to its flipped name's index. """
+	names = list(names)
+	indices = {name : i for i, name in enumerate(names)}
+	flipped = []
+	for name in list(names):
+		flipped_name = utils.flip_name(name)
+		if(flipped_name not in indices):
+			indices[flipped_name] = len(names)
+			names.append(flipped_name)
+		flipped.append(indices[flipped_name])
+	# The added flipped names flip back to the original names.
+	for i in range(len(flipped), len(names)):
+		flipped.append(indices.get(utils.flip_name(names[i]), i))
+	return names, np.array(flipped, dtype=np.int64)
+
+def mirror_result(result, vert_count, mirrored, partners, flipped_cols):
+	""" Adds the weights of each partner vert to its mirrored vert, with the groups flipped, to a (rows, cols, values) result. """
+	rows, cols, values = result
+	order = np.argsort(rows, kind='stable')
+	rows, cols, values = rows[order], cols[order], values[order]
+	
+	offsets = np.zeros(vert_count+1, dtype=np.int64)
+	offsets[1:] = np.cumsum(np.bincount(rows, minlength=vert_count))
+	starts = offsets[partners]
+	lengths = offsets[partners+1] - starts
+	entries = expand_ranges(starts, lengths)
+	
+	return (np.concatenate((rows, np.repeat(mirrored, lengths))), 
+		np.concatenate((cols, flipped_cols[cols[entries]])), 
+		np.concatenate((values, values[entries])))
+
+class SourceProxy:
+	""" Decimated version of a source object made by vertex clustering. Each occupied cell of a grid becomes one vertex, placed at the average position of the verts inside it. """
+	def __init__(self, coords, cluster_size):
+		cells = np.floor(coords / cluster_size).astype(np.int64)
+		cells, clusters, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+		self.clusters = clusters.ravel()	# Cluster index of each source vert.
+		self.counts = counts				# Number of source verts in each cluster.
+		centers = np.stack([np.bincount(self.clusters, weights=coords[:, axis], minlength=len(counts)) for axis in range(3)], axis=1) / counts[:, None]
+		self.kd = build_kdtree(None, centers)
+		self.tables = weakref.WeakKeyDictionary()	# {Full resolution WeightTable : Averaged WeightTable}
+	
+	def __len__(self):
+		return len(self.counts)
+	
+	def get_weight_table(self, weights):
+		""" Returns a WeightTable with the weights of each cluster, averaged from the verts inside it. """
+		if(weights in self.tables):
+			return self.tables[weights]
 		
-		# Sort valid verts by distance (least to most distance)
-		source_verts.sort(key=lambda tup: tup[1])
+		group_count = max(1, len(weights.names))
+		entry_verts = np.repeat(np.arange(len(weights)), np.diff(weights.offsets))
+		keys, inverse = np.unique(self.clusters[entry_verts]*group_count + weights.groups, return_inverse=True)
+		sums = np.bincount(inverse.ravel(), weights=weights.weights, minlength=len(keys))
+		clusters = keys // group_count
 		
-		# Iterating through the source verts, from closest to furthest, and accumulating our target weight for each vertex group.
-		vgroup_weights = {}	# Dictionary of Vertex Group Name : Weight
-		for i in range(0, len(source_verts)):
-			vert = source_verts[i]
-			# The closest vert's weights are multiplied by the farthest vert's distance, and vice versa. The 2nd closest will use the 2nd farthest, etc.
-			# Note: The magnitude of the distance vectors doesn't matter because at the end they will be normalized anyways.
-			pair_distance = source_verts[-i-1][1]
-			for vg_name, vg_weight in weights[vert[0]]:
-				new_weight = vg_weight * pair_distance
-				if(vg_name not in vgroup_weights):
-					vgroup_weights[vg_name] = new_weight
-				else:
-					vgroup_weights[vg_name] = vgroup_weights[vg_name] + new_weight
+		offsets = np.zeros(len(self)+1, dtype=np.int64)
+		offsets[1:] = np.cumsum(np.bincount(clusters, minlength=len(self)))
+		table = WeightTable(weights.names, offsets, (keys % group_count).astype(np.int32), sums / self.counts[clusters])
+		self.tables[weights] = table
+		return table
+
+# Cache of source object data, so that transferring onto many targets, or re-running the operator from the redo panel, doesn't rebuild it every time.
+source_caches = {}	# {source object pointer : SourceCache}
+
+class SourceCache:
+	""" Holds the KD-tree, the weight tables and the decimated proxies of a source object. """
+	def __init__(self, obj):
+		self.geometry_key = SourceCache.get_geometry_key(obj)
+		self.coords = get_coords(obj)
+		self._kd = None
+		self.tables = {}	# {(group names, combine dict) : WeightTable}
+		self.proxies = {}	# {cluster size : SourceProxy}
+	
+	@property
+	def kd(self):
+		# Built on first use, so that transferring only from a proxy doesn't have to build it.
+		if(self._kd is None):
+			self._kd = build_kdtree(None, self.coords)
+		return self._kd
+	
+	def get_proxy(self, cluster_size):
+		if(cluster_size not in self.proxies):
+			self.proxies[cluster_size] = SourceProxy(self.coords, cluster_size)
+		return self.proxies[cluster_size]
+	
+	@staticmethod
+	def get_geometry_key(obj):
+		return (obj.data.as_pointer(), len(obj.data.vertices))
+	
+	def get_weight_table(self, obj, vgroups, mask_vgroup=None, bone_combine_dict=None):
+		""" Same as build_weight_table(), but re-uses the result when the same groups and combine dict were requested before. """
+		if(mask_vgroup):
+			# The mask group belongs to the target object, which is the one being written to, so don't cache masked weights.
+			return build_weight_table(obj, vgroups, mask_vgroup, bone_combine_dict)
 		
-		# The sum is used to normalize the weights. This is important because otherwise the values would depend on object scale, and in the case of very small or very large objects, stuff could get culled.
-		weights_sum = sum(vgroup_weights.values())
+		combine_key = None
+		if(bone_combine_dict):
+			combine_key = tuple(sorted((name, tuple(sub_names)) for name, sub_names in bone_combine_dict.items()))
+		key = (tuple(vg.name for vg in vgroups), combine_key)
 		
-		# Assigning the final, normalized weights of this vertex to the vertex groups.
-		for vg_avg in vgroup_weights.keys():
-			target_vg = obj_to.vertex_groups.get(vg_avg)
-			if(target_vg == None):
-				target_vg = obj_to.vertex_groups.new(name=vg_avg)
-			target_vg.add([v.index], vgroup_weights[vg_avg]/weights_sum, 'REPLACE')
+		if(key not in self.tables):
+			self.tables[key] = build_weight_table(obj, vgroups, mask_vgroup, bone_combine_dict)
+		return self.tables[key]
+
+def get_source_cache(obj):
+	""" Returns the SourceCache of the object, (re)building it if it doesn't exist or the object's mesh was swapped or resized. """
+	cache = source_caches.get(obj.as_pointer())
+	if(cache is None or cache.geometry_key != SourceCache.get_geometry_key(obj)):
+		cache = SourceCache(obj)
+		source_caches[obj.as_pointer()] = cache
+	return cache
+
+def clear_source_caches():
+	source_caches.clear()
+
+@persistent
+def invalidate_source_caches(scene, depsgraph=None):
+	""" Drop the cache of any source object whose mesh was changed, eg. by editing it or painting weights on it. """
+	if(not source_caches): return
+	if(depsgraph is None):
+		depsgraph = bpy.context.evaluated_depsgraph_get()
+	for update in depsgraph.updates:
+		if(not update.is_updated_geometry): continue
+		datablock = update.id.original
+		if(type(datablock)==bpy.types.Object):
+			source_caches.pop(datablock.as_pointer(), None)
+		elif(type(datablock)==bpy.types.Mesh):
+			for key, cache in list(source_caches.items()):
+				if(cache.geometry_key[0] == datablock.as_pointer()):
+					del source_caches[key]
+
+@persistent
+def clear_source_caches_on_load(dummy):
+	clear_source_caches()
+
+# Source data of the parallel transfer. Set before the process pool is created, so that the forked workers inherit it instead of having it sent with every task.
+pool_source = None	# List of (KD-tree, WeightTable) tuples
+
+def can_transfer_parallel():
+	# The workers need to inherit the mathutils KD-tree, so only the fork start method works.
+	return 'fork' in multiprocessing.get_all_start_methods()
+
+def transfer_weights_worker(task):
+	source_index, start, coords, max_verts, max_dist, dist_multiplier = task
+	kd, weights = pool_source[source_index]
+	rows, cols, values = transfer_weights(kd, weights, coords.reshape(-1, 3).tolist(), max_verts, max_dist, dist_multiplier)
+	return rows + start, cols, values
+
+def transfer_weights_parallel(sources, target_coords, max_verts=30, max_dist=10, dist_multiplier=1000, processes=None):
+	""" Runs transfer_weights() for several targets in a process pool.
+		sources: List of (KD-tree, WeightTable) tuples, one per target.
+		target_coords: List of flat or (n, 3) coordinate arrays, one per target.
+		Large targets are split into chunks, so that all processes are kept busy even when there are only a few targets.
+		Returns a list of (rows, cols, values) results, one per target.
+	"""
+	global pool_source
+	processes = processes or os.cpu_count()
+	target_coords = [np.asarray(coords, dtype=np.float32).reshape(-1, 3) for coords in target_coords]
+	
+	total = sum(len(coords) for coords in target_coords)
+	chunk_size = max(1000, -(-total // (processes*4)))
+	tasks = []
+	for i, coords in enumerate(target_coords):
+		for start in range(0, len(coords), chunk_size):
+			tasks.append((i, start, coords[start:start+chunk_size].ravel(), max_verts, max_dist, dist_multiplier))
+	
+	pool_source = sources
+	try:
+		with multiprocessing.get_context('fork').Pool(min(processes, max(1, len(tasks)))) as pool:
+			chunk_results = pool.map(transfer_weights_worker, tasks)
+	finally:
+		pool_source = None
+	
+	results = [[] for coords in target_coords]
+	for task, chunk_result in zip(tasks, chunk_results):
+		results[task[0]].append(chunk_result)
+	
+	return [concatenate_results(chunks) for chunks in results]
+
+def smart_transfer_weights(obj_from, obj_to, weights, max_verts=30, max_dist=10, dist_multiplier=1000, kd=None):
+	""" Smart Vertex Weight Transfer.
+		The number of nearby verts which it searches for depends on how far the nearest vert is. (This is controlled by max_verts, max_dist and dist_multiplier)
+		This means if a very close vert is found, it won't look for any more verts.
+		If the nearest vert is quite far away(or dist_multiplier is set high), it will average the influences of a larger number few verts.
+		The averaging of the influences is also weighted by their distance, so that a vertex which is twice as far away will contribute half as much influence to the final result.
+		weights: a WeightTable of the source vertex weights, built with build_weight_table().
+		kd: KD-tree of obj_from, eg. from get_source_cache(). Built if not passed.
+	"""
+	if(kd is None):
+		kd = build_kdtree(obj_from)
+	coords = get_coords(obj_to).tolist()
+	
+	rows, cols, values = transfer_weights(kd, weights, coords, max_verts, max_dist, dist_multiplier)
+	write_weights(obj_to, weights.names, rows, cols, values)
 	
 	bpy.ops.object.mode_set(mode='WEIGHT_PAINT')
 
@@ -153,12 +522,10 @@ w3_bone_dict_str = """{
 
 w3_vgroups = ['Hip_Def', 'Butt_Mid', 'Neck_Def', 'Head_Def', 'Breast.R', 'Breast.L', 'Clavicle_Def.R', 'Clavicle_Adjust.R', 'Clavicle_Def.L', 'Clavicle_Adjust.L', 'Spine3_Def', 'Spine2_Def', 'Spine1_Def', 'Adjust_Knee.R', 'Twist_Leg_2.R', 'Twist_Leg_1.R', 'Foot_Def.R', 'Toes_Def.R', 'Toe_Def.R', 'Butt.R', 'Thigh_Def.R', 'Twist_Leg_3.R', 'Adjust_Thigh_Front.R', 'Adjust_Thigh_Side.R', 'Twist_Leg_4.R', 'Adjust_Knee.L', 'Twist_Leg_2.L', 'Twist_Leg_1.L', 'Foot_Def.L', 'Toes_Def.L', 'Toe_Def.L', 'Butt.L', 'Thigh_Def.L', 'Twist_Leg_3.L', 'Adjust_Thigh_Front.L', 'Adjust_Thigh_Side.L', 'Twist_Leg_4.L', 'Elbow_Def.R', 'Adjust_Elbow_Lower.R', 'Shoulder_Def.R', 'Adjust_Elbow_Upper.R', 'Twist_Arm_5.R', 'Twist_Arm_6.R', 'Twist_Arm_2.R', 'Twist_Arm_1.R', 'Twist_Arm_4.R', 'Twist_Arm_3.R', 'Hand_Def.R', 'Elbow_Def.L', 'Adjust_Elbow_Lower.L', 'Shoulder_Def.L', 'Adjust_Elbow_Upper.L', 'Twist_Arm_5.L', 'Twist_Arm_6.L', 'Twist_Arm_1.L', 'Twist_Arm_2.L', 'Twist_Arm_4.L', 'Twist_Arm_3.L', 'Hand_Def.L']
 
-class SmartWeightTransferOperator(bpy.types.Operator):
-	"""Transfer weights from active to selected objects based on weighted vert distances."""
-	bl_idname = "object.smart_weight_transfer"
-	bl_label = "Smart Transfer Weights"
-	bl_options = {'REGISTER', 'UNDO'}
-	
+class SmartWeightTransferBase:
+	""" Options and shared steps of the Smart Transfer Weights operators.
+		Blender only registers the properties of base classes that aren't registered types themselves, so this is a plain class that both operators inherit from.
+	"""
 	opt_source_vgroups: EnumProperty(name="Source Groups",
 		items=[("ALL", "All", "All"),
 				("SELECTED", "Selected Bones", "Selected Bones"),
@@ -193,6 +560,50 @@ class SmartWeightTransferOperator(bpy.types.Operator):
 		items=get_vgroups,
 		description="The operator's effect will be masked by this vertex group, unless 'None'")
 	
+	opt_parallel: BoolProperty(name="Parallel",
+		default=False,
+		description="Calculate the weights in a pool of processes. Speeds up transferring onto many or very large target objects. Not supported on Windows")
+	
+	opt_processes: IntProperty(name="Processes",
+		default=0, min=0,
+		description="Number of processes to use for parallel transfer. 0 means one per CPU core")
+	
+	opt_proxy: BoolProperty(name="Decimated Source",
+		default=False,
+		description="Transfer from a decimated version of the source, made by merging the verts inside each cell of a grid and averaging their weights. Much faster for very dense source meshes")
+	
+	opt_proxy_cluster_size: FloatProperty(name="Cluster Size",
+		default=0.01, min=0.00001, precision=4,
+		description="Size of the grid cells whose verts are merged in the decimated source")
+	
+	opt_proxy_band: FloatProperty(name="Full Resolution Distance",
+		default=0, min=0, precision=4,
+		description="Target verts closer than this to the decimated source are transferred from the full resolution source instead")
+	
+	opt_proxy_report: BoolProperty(name="Report Deviation",
+		default=False,
+		description="Also transfer from the full resolution source, and report how much the result from the decimated source differs from it. Slow")
+	
+	opt_affect: EnumProperty(name="Affect",
+		items=[("ALL", "All Verts", "Transfer onto all verts of the targets"),
+				("SELECTED", "Selected Verts", "Only transfer onto the selected verts of the targets, and leave the weights of other verts untouched"),
+				("MASK", "Masked Verts", "Only transfer onto the verts of the targets that have weight in the Operator Mask group, and leave the weights of other verts untouched"),
+				],
+		description="Which verts of the target objects to transfer onto. With Wipe originals, only the affected verts are removed from the transferred groups",
+		default="ALL")
+	
+	opt_symmetric: BoolProperty(name="Symmetric",
+		default=False,
+		description="Only transfer onto the +X half of symmetric targets, and mirror the result onto the -X half with flipped group names. Verts without a mirrored partner are transferred normally")
+	
+	opt_symmetry_tolerance: FloatProperty(name="Symmetry Tolerance",
+		default=0.0001, min=0, precision=5,
+		description="Maximum distance between a vert and the mirrored position of its partner")
+	
+	opt_weight_steps: IntProperty(name="Rounding Steps",
+		default=0, min=0,
+		description="Round the transferred weights to multiples of 1 divided by this number, so they can be written in far fewer calls. This changes the result: weights won't add up to exactly 1, and tiny weights become 0. 0 keeps the weights at full precision")
+	
 	opt_bone_combine_dict: StringProperty(name='Combine Dict',
 		description="If you want some groups to be considered part of others(eg. to avoid transferring individual toe weights onto shoes), you can enter them here in the form of a valid Python dictionary, where the keys are the parent group name, and values are lists of child group names, eg: {'Toe_Main.L' : ['Toe1.L', 'Toe2.L'], 'Toe_Main.R' : ['Toe1.R', 'Toe2.R']}",
 		default=w3_bone_dict_str
@@ -202,10 +613,30 @@ class SmartWeightTransferOperator(bpy.types.Operator):
 	def poll(cls, context):
 		return (context.object is not None) and (context.object.mode=='WEIGHT_PAINT')
 	
-	def draw(self, context):
-		operator = self.layout.operator(SmartWeightTransferOperator.bl_idname, text=SmartWeightTransferOperator.bl_label)
-
-	def execute(self, context):
+	def get_source_vgroups(self, context, source_obj):
+		vgroups = []
+		error = ""
+		if(self.opt_source_vgroups == "ALL"):
+			vgroups = source_obj.vertex_groups
+			error = "the source has no vertex groups."
+		elif(self.opt_source_vgroups == "SELECTED"):
+			assert context.selected_pose_bones, "No selected pose bones to transfer from."
+			vgroups = [source_obj.vertex_groups.get(b.name) for b in context.selected_pose_bones]
+			error = "no bones were selected."
+		elif(self.opt_source_vgroups == "DEFORM"):
+			vgroups = [source_obj.vertex_groups.get(b.name) for b in context.pose_object.data.bones if b.use_deform]
+			error = "there are no deform bones"
+		
+		# Using hard coded vertex group names because it's easier than selecting all the right bones, I guess? TODO: could turn that hardcoded list into a parameter, just like the bone dict.
+		# vgroups = [source_obj.vertex_groups.get(vgn) for vgn in w3_vgroups]
+		
+		# Clean up
+		vgroups = [vg for vg in vgroups if vg != None]
+		assert len(vgroups) > 0, "No transferable Vertex Groups were found, " + error
+		return vgroups
+	
+	def prepare_targets(self, context):
+		""" Returns the source cache and a list of (target object, WeightTable) tuples to transfer. Doesn't modify any data yet. """
 		assert len(context.selected_objects) > 1, "At least two objects must be selected. Select the source object last, and enter weight paint mode."
 		
 		bone_dict = ""
@@ -213,53 +644,307 @@ class SmartWeightTransferOperator(bpy.types.Operator):
 			bone_dict = eval(self.opt_bone_combine_dict)
 		
 		source_obj = context.object
-		for o in context.selected_objects:
-			if(o==source_obj or o.type!='MESH'): continue
-			bpy.ops.object.mode_set(mode='OBJECT')
-			bpy.ops.object.select_all(action='DESELECT')
+		cache = get_source_cache(source_obj)
+		vgroups = self.get_source_vgroups(context, source_obj)
+		vgroup_names = [vg.name for vg in vgroups]
+		if(self.opt_symmetric):
+			# The flipped groups are written to, and wiped, as well.
+			vgroup_names = get_flipped_names(vgroup_names)[0]
+		targets = [o for o in context.selected_objects if o!=source_obj and o.type=='MESH']
+		
+		jobs = []
+		for o in targets:
+			mask_vgroup = o.vertex_groups.get(self.opt_mask_vgroup)
+			if(self.opt_wipe_originals and self.opt_affect=='ALL' and self.opt_mask_vgroup in vgroup_names):
+				# The mask group is going to be wiped before the transfer.
+				mask_vgroup = None
 			
-			vgroups = []
-			error = ""
-			if(self.opt_source_vgroups == "ALL"):
-				vgroups = o.vertex_groups
-				error = "the source has no vertex groups."
-			elif(self.opt_source_vgroups == "SELECTED"):
-				assert context.selected_pose_bones, "No selected pose bones to transfer from."
-				vgroups = [source_obj.vertex_groups.get(b.name) for b in context.selected_pose_bones]
-				error = "no bones were selected."
-			elif(self.opt_source_vgroups == "DEFORM"):
-				vgroups = [source_obj.vertex_groups.get(b.name) for b in context.pose_object.data.bones if b.use_deform]
-				error = "there are no deform bones"
+			weights = cache.get_weight_table(source_obj, vgroups, mask_vgroup, bone_dict)
+			jobs.append((o, weights))
+		
+		return cache, jobs
+	
+	def get_affected_verts(self, o):
+		""" Returns a boolean array of which verts of the target should be transferred onto, or None for all of them. """
+		if(self.opt_affect == 'SELECTED'):
+			affected = np.zeros(len(o.data.vertices), dtype=bool)
+			o.data.vertices.foreach_get('select', affected)
+			return affected
+		if(self.opt_affect == 'MASK'):
+			mask_vgroup = o.vertex_groups.get(self.opt_mask_vgroup)
+			assert mask_vgroup, "The target object %s has no vertex group named %s to use as a mask." %(o.name, self.opt_mask_vgroup)
+			return np.array([w is not None and w > 0 for w in get_vgroup_weights(mask_vgroup)], dtype=bool)
+		return None
+	
+	def write_results(self, context, jobs, results, names, affected_verts):
+		""" Wipes the target objects' groups if needed, and writes the transferred weights. Has to happen on the main thread. """
+		bpy.ops.object.mode_set(mode='OBJECT')
+		bpy.ops.object.select_all(action='DESELECT')
+		
+		for (o, weights), (rows, cols, values), result_names, affected in zip(jobs, results, names, affected_verts):
+			# Delete the vertex groups from the destination mesh first...
+			# With Symmetric, the result names also include the flipped groups that the mirrored weights are written to.
+			if(self.opt_wipe_originals):
+				for vg_name in result_names:
+					vg = o.vertex_groups.get(vg_name)
+					if(vg is None): continue
+					if(affected is None):
+						o.vertex_groups.remove(vg)
+					else:
+						# Only from the affected verts, so other verts are left untouched.
+						vg.remove(np.flatnonzero(affected).tolist())
 			
-			# Using hard coded vertex group names because it's easier than selecting all the right bones, I guess? TODO: could turn that hardcoded list into a parameter, just like the bone dict.
-			# vgroups = [source_obj.vertex_groups.get(vgn) for vgn in w3_vgroups]
+			write_weights(o, result_names, rows, cols, values, self.opt_weight_steps)
+		
+		if(len(jobs) > 0):
+			bpy.context.view_layer.objects.active = jobs[-1][0]
+		bpy.ops.object.mode_set(mode='WEIGHT_PAINT')
+	
+	def get_parts(self, cache, jobs):
+		""" Splits the transfer into parts.
+			Returns a list of (target index, vertex indices, KD-tree, WeightTable, coords) tuples, where vertex indices is None for all verts, 
+			a list with the (mirrored verts, partner verts) of each target, or None, 
+			and a list with the boolean array of affected verts of each target, or None.
+		"""
+		parts = []
+		mirror_maps = []
+		affected_verts = []
+		for i, (o, weights) in enumerate(jobs):
+			coords = get_coords(o)
+			indices = None
+			affected = self.get_affected_verts(o)
+			affected_verts.append(affected)
 			
-			# Clean up
-			vgroups = [vg for vg in vgroups if vg != None]
-			assert len(vgroups) > 0, "No transferable Vertex Groups were found, " + error
+			computed = affected
+			mirror_map = None
+			if(self.opt_symmetric):
+				mirrored, partners = build_mirror_map(coords, self.opt_symmetry_tolerance)
+				if(affected is None):
+					computed = np.ones(len(coords), dtype=bool)
+				else:
+					# Only affected verts need to be mirrored, but their partners need to be computed even if they aren't affected.
+					computed = affected.copy()
+					mirrored, partners = mirrored[affected[mirrored]], partners[affected[mirrored]]
+				computed[mirrored] = False
+				computed[partners] = True
+				mirror_map = (mirrored, partners)
+			mirror_maps.append(mirror_map)
 			
-			# Delete the vertex groups from the destination mesh first...
-			if(self.opt_wipe_originals):
-				for vg in vgroups:
-					if(vg.name in o.vertex_groups):
-						o.vertex_groups.remove(o.vertex_groups.get(vg.name))
+			if(computed is not None):
+				indices = np.flatnonzero(computed)
+				coords = coords[indices]
 			
-			mask_vgroup = o.vertex_groups.get(self.opt_mask_vgroup)
+			if(not self.opt_proxy):
+				parts.append((i, indices, cache.kd, weights, coords))
+				continue
 			
-			weights = build_weight_dict(source_obj, vgroups, mask_vgroup, bone_dict)
-			smart_transfer_weights(source_obj, o, weights, self.opt_max_verts, self.opt_max_dist, self.opt_dist_multiplier)
+			proxy = cache.get_proxy(self.opt_proxy_cluster_size)
+			proxy_weights = proxy.get_weight_table(weights)
+			if(self.opt_proxy_band <= 0):
+				parts.append((i, indices, proxy.kd, proxy_weights, coords))
+				continue
 			
-			bpy.context.view_layer.objects.active = o
-			bpy.ops.object.mode_set(mode='WEIGHT_PAINT')
+			if(indices is None):
+				indices = np.arange(len(coords))
+			near = find_nearest_dists(proxy.kd, coords.tolist()) < self.opt_proxy_band
+			parts.append((i, indices[near], cache.kd, weights, coords[near]))
+			parts.append((i, indices[~near], proxy.kd, proxy_weights, coords[~near]))
+		return parts, mirror_maps, affected_verts
+	
+	def merge_results(self, cache, jobs, parts, mirror_maps, affected_verts, part_results):
+		""" Joins the part results into one result per target, mirrors them if needed, and drops the verts that were only computed to be mirrored.
+			Returns the results and the list of group names of each result.
+		"""
+		results = merge_part_results(len(jobs), parts, part_results)
+		if(self.opt_proxy and self.opt_proxy_report):
+			self.report_proxy_deviation(cache, jobs, parts, results)
+		
+		names = [weights.names for o, weights in jobs]
+		for i, mirror_map in enumerate(mirror_maps):
+			if(mirror_map is None): continue
+			names[i], flipped_cols = get_flipped_names(names[i])
+			results[i] = mirror_result(results[i], len(jobs[i][0].data.vertices), mirror_map[0], mirror_map[1], flipped_cols)
+		
+		for i, affected in enumerate(affected_verts):
+			if(affected is None): continue
+			keep = affected[results[i][0]]
+			results[i] = tuple(array[keep] for array in results[i])
+		return results, names
+	
+	def transfer_parts(self, parts):
+		""" Transfers the weights of every part, in a process pool if enabled. Returns a list of (rows, cols, values) results, one per part. """
+		processes = 1
+		if(self.opt_parallel):
+			processes = self.opt_processes or os.cpu_count()
+			if(not can_transfer_parallel()):
+				self.report({'WARNING'}, "Parallel transfer is not supported on this platform, transferring on a single core.")
+				processes = 1
+		
+		if(processes > 1 and len(parts) > 0):
+			sources = [(kd, weights) for i, indices, kd, weights, coords in parts]
+			return transfer_weights_parallel(sources, [coords for i, indices, kd, weights, coords in parts], self.opt_max_verts, self.opt_max_dist, self.opt_dist_multiplier, processes)
+		return [transfer_weights(kd, weights, coords.tolist(), self.opt_max_verts, self.opt_max_dist, self.opt_dist_multiplier) for i, indices, kd, weights, coords in parts]
+	
+	def report_proxy_deviation(self, cache, jobs, parts, results):
+		# Transferring the same verts again, but all from the full resolution source.
+		full_parts = [(i, indices, cache.kd, jobs[i][1], coords) for i, indices, kd, weights, coords in parts]
+		full_results = merge_part_results(len(jobs), full_parts, self.transfer_parts(full_parts))
+		max_dev, mean_dev, total = 0.0, 0.0, 0
+		for (o, weights), result, full_result in zip(jobs, results, full_results):
+			job_max, job_mean = compare_results(result, full_result, len(weights.names))
+			count = len(result[0])
+			max_dev = max(max_dev, job_max)
+			mean_dev += job_mean * count
+			total += count
+		
+		proxy = cache.get_proxy(self.opt_proxy_cluster_size)
+		self.report({'INFO'}, "Decimated source has %d of %d verts. Deviation from full resolution: max %.4f, mean %.4f" %(len(proxy), len(cache.coords), max_dev, mean_dev/max(1, total)))
+
+class SmartWeightTransferOperator(SmartWeightTransferBase, bpy.types.Operator):
+	"""Transfer weights from active to selected objects based on weighted vert distances."""
+	bl_idname = "object.smart_weight_transfer"
+	bl_label = "Smart Transfer Weights"
+	bl_options = {'REGISTER', 'UNDO'}
+	
+	def draw(self, context):
+		operator = self.layout.operator(SmartWeightTransferOperator.bl_idname, text=SmartWeightTransferOperator.bl_label)
+	
+	def execute(self, context):
+		cache, jobs = self.prepare_targets(context)
+		parts, mirror_maps, affected_verts = self.get_parts(cache, jobs)
+		results, names = self.merge_results(cache, jobs, parts, mirror_maps, affected_verts, self.transfer_parts(parts))
+		self.write_results(context, jobs, results, names, affected_verts)
+		return { 'FINISHED' }
+
+class SmartWeightTransferModal(SmartWeightTransferBase, bpy.types.Operator):
+	"""Transfer weights from active to selected objects based on weighted vert distances, a chunk of verts at a time. Shows progress and can be cancelled with Esc."""
+	bl_idname = "object.smart_weight_transfer_modal"
+	bl_label = "Smart Transfer Weights (Interactive)"
+	bl_options = {'REGISTER', 'UNDO'}
+	
+	opt_chunk_size: IntProperty(name="Chunk Size",
+		default=20000, min=1,
+		description="Number of target verts to process between updates of the interface")
+	
+	def draw(self, context):
+		operator = self.layout.operator(SmartWeightTransferModal.bl_idname, text=SmartWeightTransferModal.bl_label)
+	
+	def invoke(self, context, event):
+		self.cache, self.jobs = self.prepare_targets(context)
+		self.parts, self.mirror_maps, self.affected_verts = self.get_parts(self.cache, self.jobs)
+		# The interface stays usable while the operator runs, so the targets are checked for changes before writing to them.
+		self.target_meshes = [(o.data.as_pointer(), len(o.data.vertices)) for o, weights in self.jobs]
+		# Everything is written only once all targets are done, so cancelling doesn't have to undo anything.
+		self.coords = [part[4].tolist() for part in self.parts]
+		self.results = [[] for part in self.parts]
+		self.part_index = 0
+		self.start = 0
+		self.done = 0
+		self.total = sum(len(coords) for coords in self.coords)
+		
+		wm = context.window_manager
+		wm.progress_begin(0, max(1, self.total))
+		self.timer = wm.event_timer_add(0.01, window=context.window)
+		wm.modal_handler_add(self)
+		return {'RUNNING_MODAL'}
+	
+	def step(self):
+		""" Transfers the next chunk of target verts. Returns whether all parts are done. """
+		while(self.part_index < len(self.parts) and self.start >= len(self.coords[self.part_index])):
+			self.part_index += 1
+			self.start = 0
+		if(self.part_index >= len(self.parts)):
+			return True
+		
+		i, indices, kd, weights, coords = self.parts[self.part_index]
+		chunk = self.coords[self.part_index][self.start:self.start+self.opt_chunk_size]
+		rows, cols, values = transfer_weights(kd, weights, chunk, self.opt_max_verts, self.opt_max_dist, self.opt_dist_multiplier)
+		self.results[self.part_index].append((rows + self.start, cols, values))
+		
+		self.start += len(chunk)
+		self.done += len(chunk)
+		return False
+	
+	def get_changed_target(self, context):
+		""" Returns the name of a target that was deleted, edited or had its mesh changed since the operator started, or None if they're all unchanged. """
+		# Writing the results needs an active object to switch modes with.
+		if(context.object is None):
+			return "the active object"
+		for (o, weights), (mesh_pointer, vert_count) in zip(self.jobs, self.target_meshes):
+			try:
+				if(o.name not in context.scene.objects or o.mode == 'EDIT' or o.data.as_pointer() != mesh_pointer or len(o.data.vertices) != vert_count):
+					return o.name
+			except ReferenceError:
+				# The object was removed.
+				return "a removed object"
+		return None
+	
+	def end(self, context):
+		wm = context.window_manager
+		wm.event_timer_remove(self.timer)
+		wm.progress_end()
+		context.workspace.status_text_set(None)
+	
+	def modal(self, context, event):
+		if(event.type == 'ESC'):
+			self.end(context)
+			self.report({'INFO'}, "Smart Transfer Weights cancelled.")
+			return {'CANCELLED'}
+		
+		if(event.type != 'TIMER'):
+			return {'PASS_THROUGH'}
+		
+		changed = self.get_changed_target(context)
+		if(changed):
+			self.end(context)
+			self.report({'WARNING'}, "Smart Transfer Weights cancelled, because %s was changed during the transfer." %changed)
+			return {'CANCELLED'}
+		
+		if(not self.step()):
+			context.window_manager.progress_update(self.done)
+			context.workspace.status_text_set("Smart Transfer Weights: %d/%d verts (%d%%), Esc to cancel" %(self.done, self.total, 100*self.done//max(1, self.total)))
+			return {'RUNNING_MODAL'}
 		
+		self.end(context)
+		part_results = [concatenate_results(chunks) for chunks in self.results]
+		results, names = self.merge_results(self.cache, self.jobs, self.parts, self.mirror_maps, self.affected_verts, part_results)
+		self.write_results(context, self.jobs, results, names, self.affected_verts)
+		return {'FINISHED'}
+
+class ClearSmartWeightTransferCache(bpy.types.Operator):
+	"""Clear the cached KD-trees and weights of Smart Transfer Weights source objects."""
+	bl_idname = "object.smart_weight_transfer_clear_cache"
+	bl_label = "Clear Smart Transfer Weights Cache"
+	bl_options = {'REGISTER'}
+	
+	def draw(self, context):
+		operator = self.layout.operator(ClearSmartWeightTransferCache.bl_idname, text=ClearSmartWeightTransferCache.bl_label)
+	
+	def execute(self, context):
+		count = len(source_caches)
+		clear_source_caches()
+		self.report({'INFO'}, "Cleared cache of %d source objects." %count)
 		return { 'FINISHED' }
 
 def register():
 	from bpy.utils import register_class
 	register_class(SmartWeightTransferOperator)
+	register_class(SmartWeightTransferModal)
+	register_class(ClearSmartWeightTransferCache)
 	bpy.types.VIEW3D_MT_paint_weight.append(SmartWeightTransferOperator.draw)
+	bpy.types.VIEW3D_MT_paint_weight.append(SmartWeightTransferModal.draw)
+	bpy.types.VIEW3D_MT_paint_weight.append(ClearSmartWeightTransferCache.draw)
+	bpy.app.handlers.depsgraph_update_post.append(invalidate_source_caches)
+	bpy.app.handlers.load_post.append(clear_source_caches_on_load)
 
 def unregister():
 	from bpy.utils import unregister_class
 	unregister_class(SmartWeightTransferOperator)
-	bpy.types.VIEW3D_MT_paint_weight.remove(SmartWeightTransferOperator.draw)
\ No newline at end of file
+	unregister_class(SmartWeightTransferModal)
+	unregister_class(ClearSmartWeightTransferCache)
+	bpy.types.VIEW3D_MT_paint_weight.remove(SmartWeightTransferOperator.draw)
+	bpy.types.VIEW3D_MT_paint_weight.remove(SmartWeightTransferModal.draw)
+	bpy.types.VIEW3D_MT_paint_weight.remove(ClearSmartWeightTransferCache.draw)
+	bpy.app.handlers.depsgraph_update_post.remove(invalidate_source_caches)
+	bpy.app.handlers.load_post.remove(clear_source_caches_on_load)
+	clear_source_caches()
\ No newline at end of file
@@ -12,141 +12,216 @@ bl_info = {
 	"support": "COMMUNITY"
 }
 
-import bpy, bmesh, array
-from mathutils import Vector
-
-def calc_weighted_normal(bm, vert_index, edge_index, cache):
-	"""Calculates weighted normal for given combination of vertex and edge index.
-	WARNING: There is no safety check if those two belongs together.
-
-	:param bm: bmesh object
-	:type bm: bmesh
-	:param vert_index: index of the vertex to calculate normal for
-	:type vert_index: int
-	:param edge_index: index of the edge to use for calculation (vertex has to belong to this edge)
-	:returns: Vector
+import bpy
+import numpy as np
+from bpy.props import *
+
+hash_prop = "weighted_normals_hashes"
+"""Mesh ID property storing the face hashes from the last run, for incremental updates."""
+
+def get_mesh_arrays(mesh):
+	"""Reads everything needed for the weighted normals of the mesh into numpy arrays.
+
+	:param mesh: mesh to read
+	:type mesh: bpy.types.Mesh
+	:returns: dict of arrays
+	"""
+	arrays = {}
+	for collection, attr, dtype, width in (
+			(mesh.loops, 'vertex_index', np.int64, 1),
+			(mesh.loops, 'edge_index', np.int64, 1),
+			(mesh.edges, 'use_edge_sharp', bool, 1),
+			(mesh.polygons, 'loop_start', np.int64, 1),
+			(mesh.polygons, 'loop_total', np.int64, 1),
+			(mesh.polygons, 'area', np.float64, 1),
+			(mesh.polygons, 'normal', np.float64, 3)):
+		array = np.empty(len(collection) * width, dtype=dtype)
+		collection.foreach_get(attr, array)
+		arrays[attr] = array.reshape(-1, 3) if width == 3 else array
+	arrays['vertex_count'] = len(mesh.vertices)
+	return arrays
+
+def build_fan_index(arrays):
+	"""Groups the loops of the mesh into smooth fans. A fan is the set of loops around a vertex
+	whose faces are connected to each other through edges that aren't marked sharp.
+
+	:param arrays: mesh arrays from get_mesh_arrays()
+	:returns: array with the fan index of each loop, or -1 if both edges of the loop's corner are sharp, and the number of fans
+	"""
+	loop_verts = arrays['vertex_index']
+	loop_edges = arrays['edge_index']
+	starts = arrays['loop_start']
+	totals = arrays['loop_total']
+	loop_count = len(loop_verts)
+
+	# a loop's edge also touches the corner of the next loop
+	loops = np.arange(loop_count)
+	next_loops = loops + 1
+	poly_ends = starts + totals - 1
+	next_loops[poly_ends] = starts
+
+	smooth_loops = loops[~arrays['use_edge_sharp'][loop_edges]]
+	corners = np.concatenate((smooth_loops, next_loops[smooth_loops]))
+	corner_keys = loop_edges[np.concatenate((smooth_loops, smooth_loops))] * arrays['vertex_count'] + loop_verts[corners]
+
+	# loops at the same corner of the same smooth edge belong to the same fan
+	order = np.argsort(corner_keys, kind='stable')
+	corners = corners[order]
+	corner_keys = corner_keys[order]
+	group_starts = np.flatnonzero(np.diff(corner_keys, prepend=-1))
+	firsts = np.repeat(corners[group_starts], np.diff(np.append(group_starts, len(corners))))
+
+	# propagate the lowest loop index through each fan
+	labels = loops.copy()
+	while True:
+		lowest = np.minimum(labels[corners], labels[firsts])
+		new_labels = labels.copy()
+		np.minimum.at(new_labels, corners, lowest)
+		np.minimum.at(new_labels, firsts, lowest)
+		new_labels = new_labels[new_labels]
+		if np.array_equal(new_labels, labels):
+			break
+		labels = new_labels
+
+	smooth = np.zeros(loop_count, dtype=bool)
+	smooth[corners] = True
+	loop_fans = np.full(loop_count, -1, dtype=np.int64)
+	fan_labels, loop_fans[smooth] = np.unique(labels[smooth], return_inverse=True)
+
+	return loop_fans, len(fan_labels)
+
+def calc_fan_normals(arrays, loop_fans, fan_count):
+	"""Calculates the area weighted normal of every fan, as one segment sum over all loops.
+
+	:param arrays: mesh arrays from get_mesh_arrays()
+	:param loop_fans: fan index of each loop, from build_fan_index()
+	:param fan_count: number of fans, from build_fan_index()
+	:returns: (fan_count, 3) array of normalized normals
+	"""
+	weighted_normals = arrays['area'][:, None] * arrays['normal']
+	loop_polys = np.repeat(np.arange(len(arrays['loop_start'])), arrays['loop_total'])
+
+	smooth = loop_fans >= 0
+	fans = loop_fans[smooth]
+	loop_normals = weighted_normals[loop_polys[smooth]]
+	normals = np.stack([np.bincount(fans, weights=loop_normals[:, axis], minlength=fan_count) for axis in range(3)], axis=1)
+
+	lengths = np.linalg.norm(normals, axis=1)
+	np.divide(normals, lengths[:, None], out=normals, where=lengths[:, None] > 0)
+	return normals
+
+def calc_face_hashes(arrays):
+	"""Hashes the inputs of the weighted normals of each face: its area, normal, vertices, edges and their sharpness.
+
+	:param arrays: mesh arrays from get_mesh_arrays()
+	:returns: int32 array with one hash per face
+	"""
+	if len(arrays['loop_start']) == 0:
+		return np.empty(0, dtype=np.int32)
+
+	# numpy integer arrays wrap around on overflow, which is what we want here
+	loop_hashes = (arrays['vertex_index'].astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+		^ arrays['edge_index'].astype(np.uint64) * np.uint64(0xC2B2AE3D27D4EB4F)
+		^ arrays['use_edge_sharp'][arrays['edge_index']].astype(np.uint64))
+	hashes = np.add.reduceat(loop_hashes, arrays['loop_start'])
+
+	floats = np.column_stack((arrays['area'], arrays['normal'])).astype(np.float32).view(np.uint32).astype(np.uint64)
+	for column in range(floats.shape[1]):
+		hashes = (hashes ^ floats[:, column]) * np.uint64(0x100000001B3)
+	hashes ^= arrays['loop_total'].astype(np.uint64)
+	hashes ^= hashes >> np.uint64(32)
+	return (hashes & np.uint64(0xFFFFFFFF)).astype(np.uint32).view(np.int32)
+
+def calc_weighted_normals(arrays, nor_list, changed_faces=None):
+	"""Calculates the weighted normal of the loops of the mesh.
+
+	:param arrays: mesh arrays from get_mesh_arrays()
+	:param nor_list: flat float32 array with 3 components per loop, to write the normals into
+	:param changed_faces: bool array of faces that changed since nor_list was calculated. If given, only the loops whose fan touches a changed face are written.
+	:returns: number of loops written
 	"""
-	normal_hash = str(vert_index) + ":" + str(edge_index)
-
-	if normal_hash in cache:
-		return cache[normal_hash]
-
-	edge = bm.edges[edge_index]
-	vert = bm.verts[vert_index]
-
-	selected_faces = []
-
-	# edge.seam = True
-	# edge.select_set(True)
-
-	for f in edge.link_faces:
-		if not f.select:
-			f.select = True
-			selected_faces.append(f)
-
-	# select linked faces of already selected edges
-	# until every smooth face around current loop is selected
-	more_selected = 1
-	while more_selected > 0:
-		more_selected = 0
-		for edge1 in vert.link_edges:
-			if edge1.smooth and edge1.select:
-				for f in edge1.link_faces:
-					if not f.select:
-						f.select = True
-						selected_faces.append(f)
-						more_selected += 1
-
-	# calc areas
-	max_area = 0
-	areas = {}
-	for i, f in enumerate(selected_faces):
-		area = f.calc_area()
-		areas[i] = area
-
-		if area > max_area:
-			max_area = area
-
-	# calc normal
-	normal = Vector()
-	for i, f in enumerate(selected_faces):
-		perc = areas[i] / max_area
-		f.normal_update()
-		normal += perc * f.normal
-
-		# also unselect all the faces
-		f.select = False
-
-	cache[normal_hash] = normal.normalized()
-	return normal.normalized()
+	loop_fans, fan_count = build_fan_index(arrays)
+	loop_polys = np.repeat(np.arange(len(arrays['loop_start'])), arrays['loop_total'])
+	smooth = loop_fans >= 0
+
+	if changed_faces is None:
+		loops = np.ones(len(loop_fans), dtype=bool)
+	else:
+		# the extra slot is picked by the -1 of sharp loops and always stays False
+		changed_loops = changed_faces[loop_polys]
+		changed_fans = np.zeros(fan_count + 1, dtype=bool)
+		changed_fans[loop_fans[changed_loops & smooth]] = True
+		loops = changed_loops | (smooth & changed_fans[loop_fans])
+		# only sum up the fans that are being rewritten
+		loop_fans = np.where(loops, loop_fans, -1)
+
+	fan_normals = calc_fan_normals(arrays, loop_fans, fan_count)
+
+	# loops with a sharp edge on both sides keep the normal of their face
+	normals = nor_list.reshape(-1, 3)
+	sharp = loops & ~smooth
+	normals[sharp] = arrays['normal'][loop_polys[sharp]]
+	smooth = loops & smooth
+	normals[smooth] = fan_normals[loop_fans[smooth]]
+	return np.count_nonzero(loops)
 
 class WeightNormalsCalculator(bpy.types.Operator):
-	"""Calculate weighted normals for active object."""
+	"""Calculate weighted normals for active and selected objects."""
 	bl_idname = "object.calculate_weighted_normals"
 	bl_label = "Weight Normals"
 	bl_options = {'REGISTER', 'UNDO'}
 
+	opt_incremental: BoolProperty(
+		name="Incremental",
+		description="Only recalculate the normals around faces that changed since the last run. Falls back to recalculating everything when the face count changed or the mesh has no custom normals",
+		default=False
+	)
+
+	@staticmethod
+	def get_meshes(context):
+		# objects sharing a mesh only need it calculated once
+		objs = [context.object] + context.selected_objects
+		return list({obj.data : None for obj in objs if obj and obj.type == 'MESH'})
+
+	@staticmethod
+	def get_changed_faces(mesh, hashes):
+		"""Compares the face hashes to the ones stored by the last run.
+
+		:returns: bool array of changed faces, or None if everything needs to be recalculated
+		"""
+		old_hashes = mesh.get(hash_prop)
+		if(old_hashes is None or len(old_hashes) != len(hashes) or not mesh.has_custom_normals):
+			return None
+		return np.array(old_hashes.to_list(), dtype=np.int32) != hashes
+
 	@classmethod
 	def poll(cls, context):
-		return context.object and context.object.mode == "OBJECT" and context.object.type == "MESH"
+		return context.mode == 'OBJECT' and len(cls.get_meshes(context)) > 0
 
 	def execute(self, context):
-		for obj in context.selected_objects:
-			if(obj.type!='MESH'): continue
-			cache = {}		# Cache for calculated weighted normals. It stores normals by key: 'vert_index:edge_index'.
-
-			mesh = obj.data
-
-			bm = bmesh.new()
-			bm.from_mesh(mesh)
-			bm.verts.ensure_lookup_table()
-			bm.edges.ensure_lookup_table()
-
-			# unselect everything first
-			for v in bm.faces:
-				v.select = False
-				v.hide = False
-
-			for v in bm.edges:
-				v.select = False
-				v.hide = False
-
-			for v in bm.verts:
-				v.select = False
-				v.hide = False
-
-			nor_list = [(0,)] * len(mesh.loops)
-			for f in bm.faces:
-
-				# map both edge indices into vertex (loop has info only about one edge)
-				verts_edge_map = {}
-				for e in f.edges:
-					for v in e.verts:
-						v_i = v.index
-						if v_i not in verts_edge_map:
-							verts_edge_map[v_i] = {e.index: 1}
-						else:
-							verts_edge_map[v_i][e.index] = 1
-
-				for curr_loop in f.loops:
-					edge_keys = verts_edge_map[curr_loop.vert.index].keys()
-
-					# if current loop vertex has at leas one sharp edge around calculate weighted normal
-					for e_i in edge_keys:
-						if not mesh.edges[e_i].use_edge_sharp:
-							curr_n = calc_weighted_normal(bm, curr_loop.vert.index, e_i, cache)
-							nor_list[curr_loop.index] = curr_n
-							break
-					else:
-						nor_list[curr_loop.index] = mesh.loops[curr_loop.index].normal
-
-			bm.free()
+		meshes = self.get_meshes(context)
+		loop_count = 0
+		for mesh in meshes:
+			arrays = get_mesh_arrays(mesh)
+			hashes = calc_face_hashes(arrays)
+			changed_faces = self.get_changed_faces(mesh, hashes) if self.opt_incremental else None
+			if(changed_faces is not None and not changed_faces.any()): continue
 
 			mesh.use_auto_smooth = True
-			bpy.ops.mesh.customdata_custom_splitnormals_clear()
-			bpy.ops.mesh.customdata_custom_splitnormals_add()
-			mesh.normals_split_custom_set(nor_list)
-			mesh.free_normals_split()
+			nor_list = np.empty(len(mesh.loops) * 3, dtype=np.float32)
+			if(changed_faces is not None):
+				# start from the current custom normals
+				mesh.calc_normals_split()
+				mesh.loops.foreach_get('normal', nor_list)
+				mesh.free_normals_split()
+
+			loop_count += calc_weighted_normals(arrays, nor_list, changed_faces)
+			mesh.normals_split_custom_set(nor_list.reshape(-1, 3))
+			if(len(hashes) > 0):
+				mesh[hash_prop] = hashes.tolist()
+
+		if(self.opt_incremental):
+			self.report({'INFO'}, "Recalculated normals of %d loops." %loop_count)
 		return {'FINISHED'}
 
 def register():
@@ -0,0 +1,111 @@
+# Helpers shared by the MetsTools benchmark scripts: argument parsing, timing, generating test meshes, and saving the results along with the git revision.
+
+import bpy
+import os
+import sys
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+
+# The MetsTools of this checkout is benchmarked, unless METSTOOLS_PATH points to another checkout, eg. a git worktree of an older revision.
+tree_path = os.environ.get('METSTOOLS_PATH') or os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.abspath(tree_path))
+import MetsTools
+
+def parse_args(parser):
+	""" Parses the arguments after '--', since the ones before it belong to Blender. """
+	argv = sys.argv[sys.argv.index('--')+1:] if '--' in sys.argv else []
+	return parser.parse_args(argv)
+
+def get_git_revision():
+	try:
+		return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=tree_path, stderr=subprocess.DEVNULL).decode().strip()
+	except (OSError, subprocess.CalledProcessError):
+		return None
+
+def timed(func, repeat, setup=None, teardown=None):
+	""" Runs func repeat times, and returns the fastest time in seconds and the result of the last run.
+		setup and teardown are called before and after each run, without being timed.
+	"""
+	best = None
+	result = None
+	for i in range(repeat):
+		if(setup):
+			setup()
+		start = time.perf_counter()
+		result = func()
+		elapsed = time.perf_counter() - start
+		best = elapsed if best is None else min(best, elapsed)
+		if(teardown):
+			teardown()
+	return best, result
+
+def get_operator(idname):
+	""" Returns the operator with an idname like 'object.clean_up', or None if it isn't registered, eg. when benchmarking an older revision. """
+	module, name = idname.split('.')
+	op = getattr(getattr(bpy.ops, module), name)
+	if(not hasattr(bpy.types, op.idname())):
+		return None
+	return op
+
+def call_operator(idname, **options):
+	""" Runs an operator, leaving out the options that it doesn't have, so the same call works against older revisions. """
+	op = get_operator(idname)
+	props = op.get_rna_type().properties.keys()
+	return op(**{key : value for key, value in options.items() if key in props})
+
+def create_grid_mesh(name, side, faces=True, offset=0.0, wave=0.0):
+	""" Creates a grid mesh of side*side verts, 2 units wide, optionally with quads between them.
+		offset moves the grid along Z, and wave makes it wavy so that nearest vertex lookups aren't all ties.
+		Returns the mesh and its vertex coordinates as an (n, 3) array.
+	"""
+	x, y = np.meshgrid(np.linspace(-1, 1, side), np.linspace(-1, 1, side))
+	z = wave * np.sin(x*7) * np.cos(y*5) + offset
+	coords = np.stack((x.ravel(), y.ravel(), z.ravel()), axis=1).astype(np.float32)
+
+	mesh = bpy.data.meshes.new(name)
+	mesh.vertices.add(len(coords))
+	mesh.vertices.foreach_set('co', coords.ravel())
+	if(faces):
+		corners = np.arange(side*side).reshape(side, side)[:-1, :-1].ravel()
+		quads = np.stack((corners, corners+1, corners+side+1, corners+side), axis=1)
+		mesh.loops.add(quads.size)
+		mesh.loops.foreach_set('vertex_index', quads.ravel().astype(np.int32))
+		mesh.polygons.add(len(quads))
+		mesh.polygons.foreach_set('loop_start', np.arange(0, quads.size, 4, dtype=np.int32))
+		mesh.polygons.foreach_set('loop_total', np.full(len(quads), 4, dtype=np.int32))
+	mesh.update(calc_edges=faces)
+	return mesh, coords
+
+def create_object(name, mesh):
+	obj = bpy.data.objects.new(name, mesh)
+	bpy.context.scene.collection.objects.link(obj)
+	return obj
+
+def delete_object(obj):
+	mesh = obj.data
+	bpy.data.objects.remove(obj)
+	bpy.data.meshes.remove(mesh)
+
+def run(run_benchmark, args):
+	""" Runs run_benchmark(args) with MetsTools registered, and saves the list of results it returns to args.output. """
+	MetsTools.register()
+	try:
+		results = run_benchmark(args)
+	finally:
+		MetsTools.unregister()
+
+	report = {
+		'time' : time.strftime("%Y-%m-%dT%H:%M:%S"),
+		'blender' : bpy.app.version_string,
+		'platform' : platform.platform(),
+		'cpu_count' : os.cpu_count(),
+		'git_revision' : get_git_revision(),
+		'repeat' : args.repeat,
+		'results' : results,
+	}
+	with open(args.output, 'w') as f:
+		json.dump(report, f, indent=4)
+	print("Results saved to " + os.path.abspath(args.output))
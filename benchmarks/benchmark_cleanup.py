@@ -0,0 +1,119 @@
+# Benchmarks for the MetsTools scene cleanup operators.
+# Run from the command line with:
+#	blender --background --factory-startup --python benchmarks/benchmark_cleanup.py -- --objects 100 1000 --output cleanup.json
+# Every run is saved as a JSON file along with the git revision, so results can be compared between revisions with compare_results.py.
+# To benchmark an older revision with this script, check it out separately and point METSTOOLS_PATH to it:
+#	git worktree add ../before <revision>
+#	METSTOOLS_PATH=../before blender --background --factory-startup --python benchmarks/benchmark_cleanup.py -- --output before.json
+
+import bpy
+import os
+import sys
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _common
+from MetsTools import cleanup_blend
+
+# Operators and the options they are run with. Operators and options that don't exist in the benchmarked revision are skipped.
+OPERATORS = {
+	'clean_up_objects' : ('object.clean_up', {'opt_objects' : 'All', 'opt_clean_materials' : True}),
+	'delete_unused_material_slots' : ('object.delete_unused_material_slots', {'opt_objects' : 'All'}),
+	'delete_unused_vgroups' : ('object.delete_unused_vgroups', {'opt_objects' : 'All'}),
+	'clean_up_materials' : ('material.clean_up', {'opt_objects' : 'All', 'opt_delete_unused_nodes' : True}),
+	'clean_up_scene' : ('scene.clean_up', {'opt_selected_only' : False, 'opt_clean_comp' : False, 'opt_report_path' : ""}),
+}
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark MetsTools cleanup operators.")
+	parser.add_argument('--objects', type=int, nargs='+', default=[100, 1000], help="Number of generated objects")
+	parser.add_argument('--resolution', type=int, default=32, help="Number of quads along each side of the generated grids")
+	parser.add_argument('--slots', type=int, default=8, help="Number of material slots on each object, of which only half are used")
+	parser.add_argument('--groups', type=int, default=16, help="Number of vertex groups on each object, of which only half have weights")
+	parser.add_argument('--repeat', type=int, default=3, help="Number of times each operator is run on a freshly generated scene. The fastest run is reported")
+	parser.add_argument('--operators', nargs='+', default=list(OPERATORS.keys()), choices=list(OPERATORS.keys()), help="Operators to run")
+	parser.add_argument('--output', default="benchmark_cleanup.json", help="JSON file to write the results to")
+	return _common.parse_args(parser)
+
+def create_material(name):
+	""" Creates a node material with an unconnected node in it. """
+	mat = bpy.data.materials.new(name)
+	mat.use_nodes = True
+	mat.node_tree.nodes.new('ShaderNodeTexImage')
+	return mat
+
+def create_scene(args, object_count):
+	""" Fills the scene with object_count grid objects that have unused material slots and empty vertex groups. """
+	mats = [create_material("Material_%02d" % i) for i in range(args.slots)]
+	for i in range(object_count):
+		mesh, coords = _common.create_grid_mesh("Grid_%d" % i, args.resolution+1)
+		for mat in mats:
+			mesh.materials.append(mat)
+		# Only the even slots get faces assigned.
+		indices = (np.arange(len(mesh.polygons)) % (args.slots//2) * 2).astype(np.int32)
+		mesh.polygons.foreach_set('material_index', indices)
+
+		obj = _common.create_object("Grid_%d" % i, mesh)
+		# Only the even groups get weights assigned.
+		verts = list(range(len(mesh.vertices)))
+		for g in range(args.groups):
+			vg = obj.vertex_groups.new(name="Group_%02d" % g)
+			if(g % 2 == 0):
+				vg.add(verts, 0.5, 'REPLACE')
+	# Some of the operators' poll functions need an active object.
+	bpy.context.view_layer.objects.active = obj
+
+def clear_scene():
+	for obj in list(bpy.data.objects):
+		bpy.data.objects.remove(obj)
+	for mesh in list(bpy.data.meshes):
+		bpy.data.meshes.remove(mesh)
+	for mat in list(bpy.data.materials):
+		bpy.data.materials.remove(mat)
+
+def run_benchmark(args):
+	results = []
+	# Removing the objects of the startup file, so that only the generated objects are cleaned up.
+	clear_scene()
+	for object_count in args.objects:
+		for name in args.operators:
+			idname, options = OPERATORS[name]
+			if(_common.get_operator(idname) is None):
+				print("%6d objects  %-30s not registered, skipped" %(object_count, name))
+				continue
+			result = {
+				'operator' : name,
+				'objects' : object_count,
+				'resolution' : args.resolution,
+				'slots' : args.slots,
+				'groups' : args.groups,
+			}
+			try:
+				result['seconds'] = _common.timed(lambda: _common.call_operator(idname, **options), args.repeat, 
+					setup=lambda: create_scene(args, object_count), 
+					teardown=clear_scene)[0]
+			except RuntimeError as e:
+				# Eg. an operator that doesn't work in the running Blender version. Recorded, so the other operators still get measured.
+				clear_scene()
+				messages = [line for line in str(e).strip().splitlines() if not line.startswith("Location:")]
+				print("%6d objects  %-30s failed: %s" %(object_count, name, messages[-1] if messages else ""))
+				result['error'] = str(e)
+				results.append(result)
+				continue
+
+			print("%6d objects  %-30s %8.3fs" %(object_count, name, result['seconds']))
+			last_report = getattr(cleanup_blend, 'last_report', None)
+			if(name == 'clean_up_scene' and last_report):
+				# Breakdown of the last run, as timed by the operator itself.
+				result['stages'] = {stage_name : stage['seconds'] for stage_name, stage in last_report.stages.items()}
+				for stage_name, seconds in result['stages'].items():
+					print("%6d objects    %-28s %8.3fs" %(object_count, stage_name, seconds))
+			results.append(result)
+	return results
+
+def main():
+	_common.run(run_benchmark, parse_args())
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,123 @@
+# Benchmarks for the MetsTools vertex weight operations.
+# Run from the command line with:
+#	blender --background --factory-startup --python benchmarks/benchmark_weights.py -- --sizes 10000 100000 1000000 --groups 64 --output weights.json
+# Every run is saved as a JSON file, so results can be compared between runs.
+
+import bpy
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import _common
+from MetsTools import smart_weight_transfer as swt
+
+STAGES = ['weight_table', 'kdtree', 'transfer', 'vgroup_nonzero_scan']
+
+def parse_args():
+	parser = argparse.ArgumentParser(description="Benchmark MetsTools weight operations.")
+	parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 100000, 1000000], help="Vertex counts of the generated source meshes")
+	parser.add_argument('--groups', type=int, default=64, help="Number of vertex groups on the generated source meshes")
+	parser.add_argument('--influences', type=int, default=4, help="Number of groups each vertex is assigned to")
+	parser.add_argument('--target-ratio', type=float, default=0.5, help="Vertex count of the transfer target, relative to the source")
+	parser.add_argument('--repeat', type=int, default=3, help="Number of times each stage is run. The fastest run is reported")
+	parser.add_argument('--stages', nargs='+', default=STAGES, choices=STAGES, help="Stages to run")
+	parser.add_argument('--output', default="benchmark_weights.json", help="JSON file to write the results to")
+	return _common.parse_args(parser)
+
+def create_grid_object(name, vert_count, offset=0.0):
+	""" Creates an object with a wavy grid of roughly vert_count verts (no faces), 2 units wide. """
+	side = max(2, int(round(vert_count ** 0.5)))
+	mesh, coords = _common.create_grid_mesh(name, side, faces=False, offset=offset, wave=0.1)
+	return _common.create_object(name, mesh), coords
+
+def add_vertex_groups(obj, coords, group_count, influences):
+	""" Assigns every vertex to the influences nearest of group_count group centers spread along X, with weights that fall off with distance. """
+	centers = np.linspace(-1, 1, group_count)
+	dists = np.abs(coords[:, 0:1] - centers[None, :])
+	nearest = np.argsort(dists, axis=1)[:, :influences]
+	weights = 1 / (1 + 10*np.take_along_axis(dists, nearest, axis=1))
+	weights /= weights.sum(axis=1, keepdims=True)
+	# Quantizing the weights, so that they can be assigned with few calls.
+	weights = np.round(weights * 64) / 64
+	
+	for g in range(group_count):
+		vg = obj.vertex_groups.new(name="Group_%03d" % g)
+		rows, cols = np.nonzero(nearest == g)
+		for w in np.unique(weights[rows, cols]):
+			if(w == 0): continue
+			vg.add(rows[weights[rows, cols] == w].tolist(), float(w), 'REPLACE')
+
+def run_nonzero_scan(obj):
+	""" Runs DeleteUnusedVGroups with only the non-zero weights check on a copy of the object, so the original keeps its groups.
+		Returns the time spent in the operator, without making the copy.
+	"""
+	copy = obj.copy()
+	copy.data = obj.data.copy()
+	bpy.context.scene.collection.objects.link(copy)
+	bpy.context.view_layer.objects.active = copy
+	try:
+		start = time.perf_counter()
+		bpy.ops.object.delete_unused_vgroups(opt_objects='Active', 
+			opt_save_bone_vgroups=False, 
+			opt_save_nonzero_vgroups=True, 
+			opt_save_modifier_vgroups=False, 
+			opt_save_shapekey_vgroups=False)
+		return time.perf_counter() - start
+	finally:
+		_common.delete_object(copy)
+
+def run_benchmark(args):
+	results = []
+	for size in args.sizes:
+		source, source_coords = create_grid_object("Source_%d" % size, size)
+		add_vertex_groups(source, source_coords, args.groups, args.influences)
+		target, target_coords = create_grid_object("Target_%d" % size, int(size * args.target_ratio), offset=0.01)
+		
+		def record(stage, seconds):
+			print("%10d verts  %-20s %8.3fs" %(len(source_coords), stage, seconds))
+			results.append({
+				'stage' : stage,
+				'verts' : len(source_coords),
+				'target_verts' : len(target_coords),
+				'groups' : args.groups,
+				'influences' : args.influences,
+				'seconds' : seconds,
+			})
+		
+		table = None
+		if('weight_table' in args.stages):
+			seconds, table = _common.timed(lambda: swt.build_weight_table(source), args.repeat)
+			record('weight_table', seconds)
+		
+		kd = None
+		if('kdtree' in args.stages):
+			seconds, kd = _common.timed(lambda: swt.build_kdtree(source), args.repeat)
+			record('kdtree', seconds)
+		
+		if('transfer' in args.stages):
+			if(table is None):
+				table = swt.build_weight_table(source)
+			if(kd is None):
+				kd = swt.build_kdtree(source)
+			def transfer():
+				rows, cols, values = swt.transfer_weights(kd, table, target_coords.tolist(), max_verts=5, max_dist=1000, dist_multiplier=1000)
+				swt.write_weights(target, table.names, rows, cols, values)
+			seconds, result = _common.timed(transfer, args.repeat)
+			record('transfer', seconds)
+		
+		if('vgroup_nonzero_scan' in args.stages):
+			seconds = min(run_nonzero_scan(source) for i in range(args.repeat))
+			record('vgroup_nonzero_scan', seconds)
+		
+		_common.delete_object(source)
+		_common.delete_object(target)
+	return results
+
+def main():
+	_common.run(run_benchmark, parse_args())
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,37 @@
+# Compares two result files of the benchmark scripts, eg. from runs before and after a change.
+# Doesn't need Blender, run it with:
+#	python benchmarks/compare_results.py before.json after.json
+
+import json
+import argparse
+
+def get_key(result):
+	""" The settings that a result was measured with, so the same measurement can be found in the other file. """
+	return tuple(sorted((k, v) for k, v in result.items() if k not in ('seconds', 'stages')))
+
+def main():
+	parser = argparse.ArgumentParser(description="Compare two MetsTools benchmark result files.")
+	parser.add_argument('before', help="JSON file of the earlier run")
+	parser.add_argument('after', help="JSON file of the later run")
+	args = parser.parse_args()
+
+	with open(args.before) as f:
+		before = json.load(f)
+	with open(args.after) as f:
+		after = json.load(f)
+	print("Before: %s (%s)" %(before.get('git_revision'), before.get('blender')))
+	print("After:  %s (%s)" %(after.get('git_revision'), after.get('blender')))
+
+	before_results = {get_key(r) : r for r in before['results']}
+	for result in after['results']:
+		key = get_key(result)
+		label = ", ".join("%s=%s" %(k, v) for k, v in key)
+		old = before_results.get(key)
+		if(old is None):
+			print("%-80s %8s -> %8.3fs" %(label, "-", result['seconds']))
+			continue
+		speedup = old['seconds'] / result['seconds'] if result['seconds'] > 0 else float('inf')
+		print("%-80s %8.3fs -> %8.3fs  %6.2fx" %(label, old['seconds'], result['seconds'], speedup))
+
+if __name__ == '__main__':
+	main()
@@ -12,8 +12,8 @@ bl_info = {
     "support": "COMMUNITY"
 }
 
-import bpy, bmesh, array
-from mathutils import Vector
+import bpy
+import numpy as np
 
 class WeightNormalsCalculator(bpy.types.Operator):
     """Calculate weighted normals for active object."""
@@ -21,83 +21,120 @@ class WeightNormalsCalculator(bpy.types.Operator):
     bl_label = "Weight Normals"
     bl_options = set()
 
-    cache = {}
-    """Cache for calculated weighted normals. It stores normals by key: 'vert_index:edge_index'."""
-
     @staticmethod
-    def calc_weighted_normal(bm, vert_index, edge_index):
-        """Calculates weighted normal for given combination of vertex and edge index.
-        WARNING: There is no safety check if those two belongs together.
-
-        :param bm: bmesh object
-        :type bm: bmesh
-        :param vert_index: index of the vertex to calculate normal for
-        :type vert_index: int
-        :param edge_index: index of the edge to use for calculation (vertex has to belong to this edge)
-        :returns: Vector
-        """
-        normal_hash = str(vert_index) + ":" + str(edge_index)
-
-        if normal_hash in WeightNormalsCalculator.cache:
-            return WeightNormalsCalculator.cache[normal_hash]
-
-        edge = bm.edges[edge_index]
-        vert = bm.verts[vert_index]
-
-        selected_faces = []
-
-        # edge.seam = True
-        # edge.select_set(True)
-
-        for f in edge.link_faces:
-
-            if not f.select:
-
-                f.select = True
-                selected_faces.append(f)
-
-        # select linked faces of already selected edges
-        # until every smooth face around current loop is selected
-        more_selected = 1
-        while more_selected > 0:
+    def get_mesh_arrays(mesh):
+        """Reads everything needed for the weighted normals of the mesh into numpy arrays.
 
-            more_selected = 0
-            for edge1 in vert.link_edges:
-
-                if edge1.smooth and edge1.select:
-
-                    for f in edge1.link_faces:
-
-                        if not f.select:
+        :param mesh: mesh to read
+        :type mesh: bpy.types.Mesh
+        :returns: dict of arrays
+        """
+        arrays = {}
+        for collection, attr, dtype, width in (
+                (mesh.loops, 'vertex_index', np.int64, 1),
+                (mesh.loops, 'edge_index', np.int64, 1),
+                (mesh.edges, 'use_edge_sharp', bool, 1),
+                (mesh.polygons, 'loop_start', np.int64, 1),
+                (mesh.polygons, 'loop_total', np.int64, 1),
+                (mesh.polygons, 'area', np.float64, 1),
+                (mesh.polygons, 'normal', np.float64, 3)):
+            array = np.empty(len(collection) * width, dtype=dtype)
+            collection.foreach_get(attr, array)
+            arrays[attr] = array.reshape(-1, 3) if width == 3 else array
+        arrays['vertex_count'] = len(mesh.vertices)
+        return arrays
 
-                            f.select = True
-                            selected_faces.append(f)
+    @staticmethod
+    def build_fan_index(arrays):
+        """Groups the loops of the mesh into smooth fans. A fan is the set of loops around a vertex
+        whose faces are connected to each other through edges that aren't marked sharp.
 
-                            more_selected += 1
+        :param arrays: mesh arrays from WeightNormalsCalculator.get_mesh_arrays()
+        :returns: array with the fan index of each loop, or -1 if both edges of the loop's corner are sharp, and the number of fans
+        """
+        loop_verts = arrays['vertex_index']
+        loop_edges = arrays['edge_index']
+        starts = arrays['loop_start']
+        totals = arrays['loop_total']
+        loop_count = len(loop_verts)
+
+        # a loop's edge also touches the corner of the next loop
+        loops = np.arange(loop_count)
+        next_loops = loops + 1
+        poly_ends = starts + totals - 1
+        next_loops[poly_ends] = starts
+
+        smooth_loops = loops[~arrays['use_edge_sharp'][loop_edges]]
+        corners = np.concatenate((smooth_loops, next_loops[smooth_loops]))
+        corner_keys = loop_edges[np.concatenate((smooth_loops, smooth_loops))] * arrays['vertex_count'] + loop_verts[corners]
+
+        # loops at the same corner of the same smooth edge belong to the same fan
+        order = np.argsort(corner_keys, kind='stable')
+        corners = corners[order]
+        corner_keys = corner_keys[order]
+        group_starts = np.flatnonzero(np.diff(corner_keys, prepend=-1))
+        firsts = np.repeat(corners[group_starts], np.diff(np.append(group_starts, len(corners))))
+
+        # propagate the lowest loop index through each fan
+        labels = loops.copy()
+        while True:
+            lowest = np.minimum(labels[corners], labels[firsts])
+            new_labels = labels.copy()
+            np.minimum.at(new_labels, corners, lowest)
+            np.minimum.at(new_labels, firsts, lowest)
+            new_labels = new_labels[new_labels]
+            if np.array_equal(new_labels, labels):
+                break
+            labels = new_labels
+
+        smooth = np.zeros(loop_count, dtype=bool)
+        smooth[corners] = True
+        loop_fans = np.full(loop_count, -1, dtype=np.int64)
+        fan_labels, loop_fans[smooth] = np.unique(labels[smooth], return_inverse=True)
+
+        return loop_fans, len(fan_labels)
 
-        # calc areas
-        max_area = 0
-        areas = {}
-        for i, f in enumerate(selected_faces):
-            area = f.calc_area()
-            areas[i] = area
+    @staticmethod
+    def calc_fan_normals(arrays, loop_fans, fan_count):
+        """Calculates the area weighted normal of every fan, as one segment sum over all loops.
 
-            if area > max_area:
-                max_area = area
+        :param arrays: mesh arrays from WeightNormalsCalculator.get_mesh_arrays()
+        :param loop_fans: fan index of each loop, from build_fan_index()
+        :param fan_count: number of fans, from build_fan_index()
+        :returns: (fan_count, 3) array of normalized normals
+        """
+        weighted_normals = arrays['area'][:, None] * arrays['normal']
+        loop_polys = np.repeat(np.arange(len(arrays['loop_start'])), arrays['loop_total'])
 
-        # calc normal
-        normal = Vector()
-        for i, f in enumerate(selected_faces):
-            perc = areas[i] / max_area
-            f.normal_update()
-            normal += perc * f.normal
+        smooth = loop_fans >= 0
+        fans = loop_fans[smooth]
+        loop_normals = weighted_normals[loop_polys[smooth]]
+        normals = np.stack([np.bincount(fans, weights=loop_normals[:, axis], minlength=fan_count) for axis in range(3)], axis=1)
 
-            # also unselect all the faces
-            f.select = False
+        lengths = np.linalg.norm(normals, axis=1)
+        np.divide(normals, lengths[:, None], out=normals, where=lengths[:, None] > 0)
+        return normals
 
-        WeightNormalsCalculator.cache[normal_hash] = normal.normalized()
+    @staticmethod
+    def calc_weighted_normals(mesh):
+        """Calculates the weighted normal of every loop of the mesh.
 
-        return normal.normalized()
+        :param mesh: mesh to calculate normals for
+        :type mesh: bpy.types.Mesh
+        :returns: flat float32 array with 3 components per loop
+        """
+        arrays = WeightNormalsCalculator.get_mesh_arrays(mesh)
+        loop_fans, fan_count = WeightNormalsCalculator.build_fan_index(arrays)
+        fan_normals = WeightNormalsCalculator.calc_fan_normals(arrays, loop_fans, fan_count)
+
+        # loops with a sharp edge on both sides keep the normal of their face
+        loop_polys = np.repeat(np.arange(len(arrays['loop_start'])), arrays['loop_total'])
+        nor_list = np.empty(len(loop_fans) * 3, dtype=np.float32)
+        normals = nor_list.reshape(-1, 3)
+        normals[:] = arrays['normal'][loop_polys]
+        smooth = loop_fans >= 0
+        normals[smooth] = fan_normals[loop_fans[smooth]]
+        return nor_list
 
     @classmethod
     def poll(cls, context):
@@ -105,71 +142,11 @@ class WeightNormalsCalculator(bpy.types.Operator):
 
     def execute(self, context):
 
-        WeightNormalsCalculator.cache = {}
-
         mesh = context.object.data
-
-        bm = bmesh.new()
-        bm.from_mesh(mesh)
-        bm.verts.ensure_lookup_table()
-        bm.edges.ensure_lookup_table()
-
-        # unselect everything first
-        for v in bm.faces:
-            v.select = False
-            v.hide = False
-
-        for v in bm.edges:
-            v.select = False
-            v.hide = False
-
-        for v in bm.verts:
-            v.select = False
-            v.hide = False
-
-        nor_list = [(0,)] * len(mesh.loops)
-        for f in bm.faces:
-
-            # map both edge indices into vertex (loop has info only about one edge)
-            verts_edge_map = {}
-            for e in f.edges:
-                for v in e.verts:
-
-                    v_i = v.index
-
-                    if v_i not in verts_edge_map:
-                        verts_edge_map[v_i] = {e.index: 1}
-                    else:
-                        verts_edge_map[v_i][e.index] = 1
-
-            for curr_loop in f.loops:
-
-                edge_keys = verts_edge_map[curr_loop.vert.index].keys()
-
-                # if current loop vertex has at leas one sharp edge around calculate weighted normal
-                for e_i in edge_keys:
-
-                    if not mesh.edges[e_i].use_edge_sharp:
-
-                        curr_n = WeightNormalsCalculator.calc_weighted_normal(bm, curr_loop.vert.index, e_i)
-                        nor_list[curr_loop.index] = curr_n
-
-                        break
-
-                else:
-
-                    nor_list[curr_loop.index] = mesh.loops[curr_loop.index].normal
-
-        bm.free()
+        nor_list = WeightNormalsCalculator.calc_weighted_normals(mesh)
 
         mesh.use_auto_smooth = True
-        bpy.ops.mesh.customdata_custom_splitnormals_clear()
-
-        bpy.ops.mesh.customdata_custom_splitnormals_add()
-        mesh.normals_split_custom_set(nor_list)
-        mesh.free_normals_split()
-
-        WeightNormalsCalculator.cache.clear()
+        mesh.normals_split_custom_set(nor_list.reshape(-1, 3))
 
         return {'FINISHED'}
 
@@ -141,6 +141,10 @@ for material in materials:
 
     material.node_tree.links.new(shader_node.outputs["BSDF"], material_output.inputs["Surface"])
 
+# Materials with different names can still end up with identical node setups, which only cost extra shader compiles.
+if hasattr(bpy.types, "MATERIAL_OT_merge_duplicates"):    # Check if the MetsTools addon is available
+    bpy.ops.material.merge_duplicates()
+
 print('Done')
 
 